@@ -5,6 +5,8 @@ import os
 from refact.src.utils import *
 from refact.src.refact_process import RefactProcessWrapper
 from refact.src.refact_sessions import RefactSessionManager, RefactSession
+from refact.src.settings import get_setting
+from refact.src.perf_stats import perf_stats
 
 start_refact = False
 refact_session_manager = None
@@ -12,7 +14,7 @@ refact_session_manager = None
 class RefactAutocomplete(sublime_plugin.EventListener):
 	def on_query_completions(self, view, prefix, locations):
 		if start_refact:
-			refact_session_manager.get_session(view).show_completions(prefix, locations)
+			refact_session_manager.get_session(view).schedule_completion()
 
 	def on_modified(self, view):
 		if not start_refact:
@@ -22,12 +24,17 @@ class RefactAutocomplete(sublime_plugin.EventListener):
 		session.notify_document_update()
 		session.update_completion()
 	
+	def on_activated(self, view):
+		if refact_session_manager:
+			refact_session_manager.process.statusbar.show(view)
+
 	def on_close(self, view):
 		if not start_refact:
 			return
 
 		session = refact_session_manager.get_session(view)
 		session.notify_close()
+		refact_session_manager.close_session(view)
 
 	def on_post_save(self, view):
 		if not start_refact:
@@ -44,10 +51,9 @@ class RefactAutocomplete(sublime_plugin.EventListener):
 	def on_post_text_command(self, view, command_name, args):
 		if start_refact:
 			session = refact_session_manager.get_session(view)
-			if command_name == "insert" and args['characters'] == '\n':
+			if command_name == "insert" and args['characters'] == '\n' and not session.completion_visible():
 				session.clear_completion()
-				cursor_point = get_cursor_point(view)
-				session.show_completions(get_cursor_line(view), [cursor_point], True)
+				session.schedule_completion()
 
 	def on_text_command(self, view, command_name, args):
 		if start_refact:
@@ -72,16 +78,58 @@ class RefactAutocomplete(sublime_plugin.EventListener):
 			elif command_name == "drag_select":
 				session.clear_completion()
 
+class RefactTextChangeListener(sublime_plugin.TextChangeListener):
+	def get_view(self):
+		view = self.buffer.primary_view()
+		if view is None or not view.is_valid():
+			return None
+		return view
+
+	def on_text_changed(self, changes):
+		view = self.get_view()
+		if view is None or refact_session_manager is None:
+			return
+
+		if not start_refact:
+			session = refact_session_manager.find_session(view)
+			if session:
+				session.invalidate_sync()
+			return
+
+		refact_session_manager.get_session(view).notify_text_changes(changes)
+
+	def on_revert(self):
+		self.resync()
+
+	def on_reload(self):
+		self.resync()
+
+	def resync(self):
+		view = self.get_view()
+		if view is None or refact_session_manager is None:
+			return
+		session = refact_session_manager.find_session(view)
+		if session:
+			session.invalidate_sync()
+			if start_refact:
+				session.notify_document_update()
+
 def plugin_loaded():
 	global refact_session_manager 
 	global start_refact
-	s = sublime.load_settings("refact.sublime-settings")
-	pause_completion = s.get("pause_completion", False)
+	pause_completion = get_setting("pause_completion", False)
 	if pause_completion:
 		sublime.status_message("⏸️ refact.ai")
 	else:
 		refact_start()
 
+def plugin_unloaded():
+	global start_refact
+	start_refact = False
+	if refact_session_manager:
+		# a reload picks the running server up again in plugin_loaded
+		refact_session_manager.park()
+
 def refact_start():
 	global refact_session_manager 
 	global start_refact
@@ -155,6 +203,34 @@ class RefactPause(sublime_plugin.TextCommand):
 			if refact_session_manager:
 				refact_session_manager.shutdown()
 
+class RefactShowServerLogCommand(sublime_plugin.WindowCommand):
+	def run(self):
+		text = ""
+		if refact_session_manager:
+			process = refact_session_manager.process
+			text = process.get_status() + "\n\n" + process.get_server_log()
+		panel = self.window.create_output_panel("refact")
+		panel.run_command("select_all")
+		panel.run_command("right_delete")
+		panel.run_command("append", {"characters": text, "scroll_to_end": True})
+		self.window.run_command("show_panel", {"panel": "output.refact"})
+
+class RefactShowPerformanceStatsCommand(sublime_plugin.WindowCommand):
+	def run(self, export = False):
+		if export:
+			view = self.window.new_file()
+			view.set_name("refact-performance-stats.json")
+			view.set_scratch(True)
+			view.assign_syntax("Packages/JSON/JSON.sublime-syntax")
+			view.run_command("append", {"characters": perf_stats.to_json()})
+			return
+
+		panel = self.window.create_output_panel("refact")
+		panel.run_command("select_all")
+		panel.run_command("right_delete")
+		panel.run_command("append", {"characters": perf_stats.get_text()})
+		self.window.run_command("show_panel", {"panel": "output.refact"})
+
 class RefactClearCompletion(sublime_plugin.TextCommand):
 	def run(self, edit):
 		refact_session_manager.get_session(self.view).clear_completion()
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# A stand-in for server/refact-lsp for load and chaos tests of the plugin,
+# with no model or network behind it. It answers initialize and
+# refact/getCompletions, keeps track of the documents the plugin opens and
+# changes, and can be made slow or unreliable on purpose.
+#
+# Set "server_path" in refact.sublime-settings to this file (it must be
+# executable), the plugin then starts it like the real server. As the plugin
+# passes the usual refact-lsp arguments, faults are configured through a JSON
+# file named by REFACT_FAKE_LSP_CONFIG, command line flags win over it:
+#
+#   {"latency_ms": 80, "latency_distribution": "lognormal", "latency_spread": 0.5,
+#    "drop_rate": 0.05, "partial_write_rate": 0.2, "crash_after_requests": 200}
+#
+# It speaks stdio like --lsp-stdin-stdout, or listens with --lsp-port PORT or
+# --lsp-unix PATH for "server_address":
+#
+#   python benchmarks/fake_refact_lsp.py --lsp-port 8001 --latency-ms 200 --drop-rate 0.1
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+
+# what a panicking rust binary exits with
+CRASH_EXIT_CODE = 101
+REQUEST_CANCELLED = -32800
+METHOD_NOT_FOUND = -32601
+DISTRIBUTIONS = ["fixed", "uniform", "normal", "lognormal", "exponential"]
+
+DEFAULTS = {
+	"latency_ms": 50,
+	# fixed: always latency_ms; uniform: latency_ms +- spread * latency_ms;
+	# normal: stddev spread * latency_ms; lognormal: median latency_ms, sigma spread;
+	# exponential: mean latency_ms
+	"latency_distribution": "fixed",
+	"latency_spread": 0.5,
+	"initialize_delay_ms": 0,
+	# completions that never get a response
+	"drop_rate": 0.0,
+	# messages written in several pieces with a pause in between
+	"partial_write_rate": 0.0,
+	"partial_write_pause_ms": 5,
+	# exit with exit_code, 0 means never
+	"crash_after_requests": 0,
+	"crash_after_seconds": 0,
+	"crash_rate": 0.0,
+	"exit_code": CRASH_EXIT_CODE,
+	# log bytes written to stderr for every message received
+	"stderr_flood_bytes": 0,
+	"completion": "print(\"hello world\")",
+	"seed": None,
+}
+
+class Config:
+	def __init__(self, values):
+		for key, value in DEFAULTS.items():
+			setattr(self, key, values.get(key, value))
+		if not self.latency_distribution in DISTRIBUTIONS:
+			raise ValueError("unknown latency distribution %s" % self.latency_distribution)
+
+class Stats:
+	def __init__(self):
+		self.started = time.monotonic()
+		self.counts = {}
+		self.lock = threading.Lock()
+
+	def count(self, name):
+		with self.lock:
+			self.counts[name] = self.counts.get(name, 0) + 1
+			return self.counts[name]
+
+	def get_text(self):
+		with self.lock:
+			counts = ", ".join("%s: %d" % item for item in sorted(self.counts.items()))
+		return "fake refact-lsp up %.1fs, %s" % (time.monotonic() - self.started, counts)
+
+class Faults:
+	def __init__(self, config, stats):
+		self.config = config
+		self.stats = stats
+		self.random = random.Random(config.seed)
+		self.lock = threading.Lock()
+
+	def chance(self, rate):
+		if rate <= 0:
+			return False
+		with self.lock:
+			return self.random.random() < rate
+
+	def get_latency(self):
+		config = self.config
+		ms = config.latency_ms
+		spread = config.latency_spread
+		with self.lock:
+			if config.latency_distribution == "uniform":
+				ms = self.random.uniform(ms * (1 - spread), ms * (1 + spread))
+			elif config.latency_distribution == "normal":
+				ms = self.random.gauss(ms, ms * spread)
+			elif config.latency_distribution == "lognormal":
+				ms = ms * self.random.lognormvariate(0, spread)
+			elif config.latency_distribution == "exponential":
+				ms = self.random.expovariate(1 / ms) if ms > 0 else 0
+		return max(ms, 0) / 1000
+
+	def check_crash(self):
+		config = self.config
+		requests = self.stats.count("requests")
+		if config.crash_after_requests and requests >= config.crash_after_requests:
+			self.crash("after %d requests" % requests)
+		if self.chance(config.crash_rate):
+			self.crash("at random")
+
+	def crash(self, reason):
+		log("crashing %s\n%s" % (reason, self.stats.get_text()))
+		# no cleanup, like a real crash
+		os._exit(self.config.exit_code)
+
+	def flood(self):
+		size = self.config.stderr_flood_bytes
+		if size <= 0:
+			return
+		line = "[fake refact-lsp] " + "x" * 100 + "\n"
+		text = line * (size // len(line) + 1)
+		log(text[:size], end = "")
+
+log_lock = threading.Lock()
+
+def log(text, end = "\n"):
+	with log_lock:
+		try:
+			sys.stderr.write(text + end)
+			sys.stderr.flush()
+		except (OSError, ValueError):
+			pass
+
+class Document:
+	def __init__(self, text, version):
+		self.text = text
+		self.version = version
+
+	def apply(self, change):
+		if change.get("range") is None:
+			self.text = change["text"]
+			return
+		lines = self.text.split("\n")
+		start = get_offset(lines, change["range"]["start"])
+		end = get_offset(lines, change["range"]["end"])
+		self.text = self.text[:start] + change["text"] + self.text[end:]
+
+def get_offset(lines, position):
+	line = min(position["line"], len(lines))
+	offset = sum(len(l) + 1 for l in lines[:line])
+	if line < len(lines):
+		offset = offset + min(position["character"], len(lines[line]))
+	return offset
+
+class Connection:
+	# One client: reads framed messages from reader and answers on writer.
+	# Completions are answered from timers, so slow ones don't hold up the
+	# rest and may arrive out of order, as with the real server.
+	def __init__(self, reader, writer, config, faults, stats):
+		self.reader = reader
+		self.writer = writer
+		self.config = config
+		self.faults = faults
+		self.stats = stats
+		self.documents = {}
+		self.pending = {}
+		self.lock = threading.Lock()
+		self.write_lock = threading.Lock()
+		self.closed = False
+
+	def run(self):
+		while True:
+			message = self.read_message()
+			if message is None:
+				break
+			self.faults.flood()
+			self.handle(message)
+		self.closed = True
+		with self.lock:
+			for timer in self.pending.values():
+				timer.cancel()
+			self.pending.clear()
+
+	def read_message(self):
+		size = None
+		while True:
+			line = self.reader.readline()
+			if not line:
+				return None
+			if line == b"\r\n":
+				break
+			name, _, value = line.decode("ascii").partition(":")
+			if name.strip().lower() == "content-length":
+				size = int(value)
+		if size is None:
+			log("message without Content-Length")
+			return None
+		body = self.reader.read(size)
+		if len(body) < size:
+			return None
+		return json.loads(body)
+
+	def write_message(self, message):
+		body = json.dumps(message).encode()
+		data = b"Content-Length: %d\r\n\r\n" % len(body) + body
+		with self.write_lock:
+			if self.closed:
+				return
+			try:
+				if self.faults.chance(self.config.partial_write_rate):
+					self.stats.count("partial_writes")
+					self.write_pieces(data)
+				else:
+					self.writer.write(data)
+					self.writer.flush()
+			except (OSError, ValueError):
+				self.closed = True
+
+	def write_pieces(self, data):
+		# cuts through the header as well as the body
+		cuts = sorted(self.faults.random.sample(range(1, len(data)), min(3, len(data) - 1)))
+		start = 0
+		for end in cuts + [len(data)]:
+			self.writer.write(data[start:end])
+			self.writer.flush()
+			start = end
+			time.sleep(self.config.partial_write_pause_ms / 1000)
+
+	def respond(self, rpc_id, result = None, error = None):
+		message = {"jsonrpc": "2.0", "id": rpc_id}
+		if error is None:
+			message["result"] = result
+		else:
+			message["error"] = error
+		self.write_message(message)
+
+	def handle(self, message):
+		method = message.get("method")
+		params = message.get("params") or {}
+		rpc_id = message.get("id")
+		self.stats.count(method or "responses")
+
+		if method == "initialize":
+			time.sleep(self.config.initialize_delay_ms / 1000)
+			self.respond(rpc_id, {"capabilities": {"textDocumentSync": 2}, "serverInfo": {"name": "fake-refact-lsp"}})
+		elif method == "refact/getCompletions":
+			self.get_completions(rpc_id, params)
+		elif method == "$/cancelRequest":
+			self.cancel(params.get("id"))
+		elif method == "textDocument/didOpen":
+			document = params["textDocument"]
+			self.documents[document["uri"]] = Document(document["text"], document.get("version", 0))
+		elif method == "textDocument/didChange":
+			self.did_change(params)
+		elif method == "textDocument/didClose":
+			if self.documents.pop(params["textDocument"]["uri"], None) is None:
+				log("didClose for a document that is not open: %s" % params["textDocument"]["uri"])
+		elif method == "textDocument/didSave":
+			pass
+		elif method == "shutdown":
+			self.respond(rpc_id, None)
+		elif method == "exit":
+			log(self.stats.get_text())
+			os._exit(0)
+		elif not rpc_id is None and not method is None:
+			self.respond(rpc_id, error = {"code": METHOD_NOT_FOUND, "message": "%s is not supported" % method})
+
+	def did_change(self, params):
+		uri = params["textDocument"]["uri"]
+		document = self.documents.get(uri)
+		if document is None:
+			log("didChange for a document that is not open: %s" % uri)
+			return
+		version = params["textDocument"].get("version")
+		if not version is None and version <= document.version:
+			log("didChange version %d after %d for %s" % (version, document.version, uri))
+		document.version = version
+		for change in params["contentChanges"]:
+			document.apply(change)
+
+	def get_completions(self, rpc_id, params):
+		self.faults.check_crash()
+		uri = params.get("textDocument", {}).get("uri")
+		if not uri in self.documents:
+			log("getCompletions for a document that is not open: %s" % uri)
+		if self.faults.chance(self.config.drop_rate):
+			self.stats.count("dropped")
+			return
+
+		timer = threading.Timer(self.faults.get_latency(), lambda: self.complete(rpc_id))
+		timer.daemon = True
+		with self.lock:
+			self.pending[rpc_id] = timer
+		timer.start()
+
+	def complete(self, rpc_id):
+		with self.lock:
+			if self.pending.pop(rpc_id, None) is None:
+				return
+		self.respond(rpc_id, {"choices": [{"code_completion": self.config.completion}], "snippet_telemetry_id": rpc_id})
+
+	def cancel(self, rpc_id):
+		with self.lock:
+			timer = self.pending.pop(rpc_id, None)
+		if timer is None:
+			return
+		timer.cancel()
+		self.stats.count("cancelled")
+		self.respond(rpc_id, error = {"code": REQUEST_CANCELLED, "message": "cancelled"})
+
+def serve_socket(server, config, faults, stats):
+	server.listen()
+	log("listening on %s" % (server.getsockname(),))
+	while True:
+		sock, _ = server.accept()
+		stats.count("connections")
+		connection = Connection(sock.makefile("rb"), sock.makefile("wb"), config, faults, stats)
+		threading.Thread(target = serve_connection, args = (connection, sock), daemon = True).start()
+
+def serve_connection(connection, sock):
+	connection.run()
+	try:
+		sock.shutdown(socket.SHUT_RDWR)
+	except OSError:
+		pass
+	sock.close()
+
+def crash_later(faults, seconds):
+	time.sleep(seconds)
+	faults.crash("after %.1fs" % seconds)
+
+def load_config(args):
+	values = {}
+	path = args.config or os.environ.get("REFACT_FAKE_LSP_CONFIG")
+	if path:
+		with open(path) as f:
+			values.update(json.load(f))
+	for key in DEFAULTS:
+		value = getattr(args, key)
+		if not value is None:
+			values[key] = value
+	return Config(values)
+
+def main():
+	parser = argparse.ArgumentParser(description = "stand-in for refact-lsp with latency and fault injection")
+	parser.add_argument("--config", help = "JSON file with the options below, also read from REFACT_FAKE_LSP_CONFIG")
+	parser.add_argument("--lsp-port", type = int, help = "listen on 127.0.0.1:PORT instead of stdio")
+	parser.add_argument("--lsp-unix", help = "listen on a unix socket instead of stdio")
+	parser.add_argument("--latency-ms", type = float)
+	parser.add_argument("--latency-distribution", choices = DISTRIBUTIONS)
+	parser.add_argument("--latency-spread", type = float)
+	parser.add_argument("--initialize-delay-ms", type = float)
+	parser.add_argument("--drop-rate", type = float)
+	parser.add_argument("--partial-write-rate", type = float)
+	parser.add_argument("--partial-write-pause-ms", type = float)
+	parser.add_argument("--crash-after-requests", type = int)
+	parser.add_argument("--crash-after-seconds", type = float)
+	parser.add_argument("--crash-rate", type = float)
+	parser.add_argument("--exit-code", type = int)
+	parser.add_argument("--stderr-flood-bytes", type = int)
+	parser.add_argument("--completion")
+	parser.add_argument("--seed", type = int)
+	# the real server's arguments, as passed by the plugin
+	args, _ = parser.parse_known_args()
+
+	config = load_config(args)
+	stats = Stats()
+	faults = Faults(config, stats)
+	if config.crash_after_seconds:
+		threading.Thread(target = crash_later, args = (faults, config.crash_after_seconds), daemon = True).start()
+
+	if args.lsp_port:
+		server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		server.bind(("127.0.0.1", args.lsp_port))
+		serve_socket(server, config, faults, stats)
+	elif args.lsp_unix:
+		if os.path.exists(args.lsp_unix):
+			os.unlink(args.lsp_unix)
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind(args.lsp_unix)
+		serve_socket(server, config, faults, stats)
+	else:
+		Connection(sys.stdin.buffer, sys.stdout.buffer, config, faults, stats).run()
+		log(stats.get_text())
+
+if __name__ == "__main__":
+	try:
+		main()
+	except KeyboardInterrupt:
+		pass
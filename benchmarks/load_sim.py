@@ -0,0 +1,652 @@
+# Drives the whole plugin headless: N fake views with a scripted typist
+# going through the same EventListener, TextChangeListener and TextCommand
+# entry points Sublime Text would call, against a real or fake server.
+# Reports completions requested, shown, discarded as stale and timed out,
+# latency percentiles per stage, and how late the main and async threads
+# ran their callbacks.
+#
+#   python benchmarks/load_sim.py --views 50 --rate 12 --duration 60
+#   python benchmarks/load_sim.py --latency-ms 300 --latency-distribution lognormal --drop-rate 0.05
+#   python benchmarks/load_sim.py --server-path ~/refact-lsp --set address_url=http://127.0.0.1:8008
+#   python benchmarks/load_sim.py --save-pattern typing.json    then --pattern typing.json to replay it
+#
+# Without --server-path or --server-address it starts benchmarks/fake_refact_lsp.py.
+# A pattern is a JSON list of events ordered by "t", seconds from the start:
+#   {"t": 1.25, "view": 3, "text": "a"}      type a character
+#   {"t": 1.40, "view": 3, "key": "enter"}   also backspace, accept (tab while a
+#                                            completion shows), escape, and
+#   {"t": 2.00, "view": 7, "key": "goto", "line": 0.5}   end of the line halfway down
+#   {"t": 2.50, "view": 7, "key": "edit", "range": [3, 0, 3, 4], "text": "x"}   replace rows/columns,
+#                                            the whole text without "range"
+# It can also be an object {"documents": [{"file_name": ..., "text": ...}], "events": [...]}
+# whose documents replace the generated ones, replay_lsp.py writes those.
+import os
+import re
+import sys
+import json
+import math
+import time
+import heapq
+import random
+import string
+import bisect
+import argparse
+import tempfile
+import urllib.parse
+import itertools
+import threading
+import traceback
+import contextlib
+import importlib.util
+from concurrent.futures import Future
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "stubs"))
+
+import sublime
+import sublime_plugin
+
+REFACT_SETTINGS = "refact.sublime-settings"
+PYTHON_SYNTAX = sublime.Syntax("Packages/Python/Python.sublime-syntax", "Python", False, "source.python")
+READY_TIMEOUT = 20
+
+class Loop:
+	# Stands in for one of Sublime's threads: runs callbacks one at a time once
+	# they are due, and records how late each of them started
+	def __init__(self, name, histogram):
+		self.name = name
+		self.lag = histogram
+		self.queue = []
+		self.sequence = itertools.count()
+		self.cond = threading.Condition()
+		self.busy = 0
+		self.errors = 0
+		threading.Thread(target = self.run, name = name, daemon = True).start()
+
+	def call(self, callback, delay = 0):
+		due = time.monotonic() + max(delay, 0) / 1000
+		with self.cond:
+			heapq.heappush(self.queue, (due, next(self.sequence), callback))
+			self.cond.notify()
+
+	def call_wait(self, callback):
+		future = Future()
+		def run():
+			try:
+				future.set_result(callback())
+			except Exception as err:
+				future.set_exception(err)
+		self.call(run)
+		return future.result()
+
+	def run(self):
+		while True:
+			with self.cond:
+				while not self.queue or self.queue[0][0] > time.monotonic():
+					self.cond.wait(self.queue[0][0] - time.monotonic() if self.queue else None)
+				due, _, callback = heapq.heappop(self.queue)
+			started = time.monotonic()
+			self.lag.record((started - due) * 1000000)
+			try:
+				callback()
+			except Exception:
+				self.errors = self.errors + 1
+				traceback.print_exc()
+			self.busy = self.busy + time.monotonic() - started
+
+class Selection(list):
+	def clear(self):
+		del self[:]
+
+	def add(self, region):
+		self.append(region)
+
+class Edit:
+	pass
+
+class FakeView:
+	# The parts of sublime.View the plugin uses, over a plain string with an
+	# index of line starts so row and column lookups stay cheap on long files
+	def __init__(self, view_id, file_name, text):
+		self.view_id = view_id
+		self.path = file_name
+		self.text = text
+		self.line_starts = [0] + [match.end() for match in re.finditer("\n", text)]
+		self.selection = Selection([sublime.Region(0)])
+		self.view_settings = sublime.Settings({"syntax": PYTHON_SYNTAX.path, "tab_size": 4})
+		# (begin, end, inserted length) of every edit, change_id() indexes into it
+		self.edits = []
+		self.pending_changes = []
+		self.statuses = {}
+		self.popup = None
+		# the typist accepted a completion and moves on to the next line
+		self.skip_line = False
+
+	def id(self):
+		return self.view_id
+
+	def file_name(self):
+		return self.path
+
+	def is_valid(self):
+		return True
+
+	def is_primary(self):
+		return True
+
+	def element(self):
+		return None
+
+	def window(self):
+		return None
+
+	def settings(self):
+		return self.view_settings
+
+	def syntax(self):
+		return PYTHON_SYNTAX
+
+	def size(self):
+		return len(self.text)
+
+	def change_count(self):
+		return len(self.edits)
+
+	def change_id(self):
+		return len(self.edits)
+
+	def sel(self):
+		return self.selection
+
+	def substr(self, x):
+		if isinstance(x, sublime.Region):
+			return self.text[x.begin():x.end()]
+		return self.text[x] if 0 <= x < len(self.text) else "\0"
+
+	def rowcol(self, point):
+		row = bisect.bisect_right(self.line_starts, point) - 1
+		return (row, point - self.line_starts[row])
+
+	def text_point(self, row, col, clamp_column = False):
+		if row >= len(self.line_starts):
+			return len(self.text)
+		point = self.line_starts[max(row, 0)] + col
+		if clamp_column:
+			point = min(point, self.line_end(row))
+		return min(point, len(self.text))
+
+	def line_end(self, row):
+		if row + 1 < len(self.line_starts):
+			return self.line_starts[row + 1] - 1
+		return len(self.text)
+
+	def line(self, x):
+		if isinstance(x, sublime.Region):
+			return sublime.Region(self.line(x.begin()).a, self.line(x.end()).b)
+		row = self.rowcol(min(max(x, 0), len(self.text)))[0]
+		return sublime.Region(self.line_starts[row], self.line_end(row))
+
+	def transform_region_from(self, region, change_id):
+		a, b = region.a, region.b
+		for begin, end, length in self.edits[change_id:]:
+			a = transform_point(a, begin, end, length)
+			b = transform_point(b, begin, end, length)
+		return sublime.Region(a, b)
+
+	def get_position(self, point):
+		row, col = self.rowcol(point)
+		prefix = self.text[self.line_starts[row]:point]
+		return sublime.HistoricPosition(point, row, col, len(prefix.encode("utf-16-le")) // 2, len(prefix.encode()))
+
+	def apply(self, begin, end, text):
+		removed = self.text[begin:end]
+		self.pending_changes.append(sublime.TextChange(self.get_position(begin), self.get_position(end), len(removed.encode("utf-16-le")) // 2, len(removed.encode()), text))
+
+		starts = self.line_starts
+		first = bisect.bisect_right(starts, begin)
+		last = bisect.bisect_right(starts, end)
+		delta = len(text) - (end - begin)
+		added = [begin + match.end() for match in re.finditer("\n", text)]
+		self.line_starts = starts[:first] + added + [start + delta for start in starts[last:]]
+		self.text = self.text[:begin] + text + self.text[end:]
+		self.edits.append((begin, end, len(text)))
+		for i, region in enumerate(self.selection):
+			self.selection[i] = sublime.Region(transform_point(region.a, begin, end, len(text)), transform_point(region.b, begin, end, len(text)))
+
+	def insert(self, edit, point, text):
+		self.apply(point, point, text)
+		return len(text)
+
+	def erase(self, edit, region):
+		self.apply(region.begin(), region.end(), "")
+
+	def replace(self, edit, region, text):
+		self.apply(region.begin(), region.end(), text)
+
+	def run_command(self, name, args = None):
+		editor.run_command(self, name, args)
+
+	def show_popup(self, content, **kwargs):
+		self.popup = content
+
+	def hide_popup(self):
+		self.popup = None
+
+	def set_status(self, key, value):
+		self.statuses[key] = value
+
+	def erase_status(self, key):
+		self.statuses.pop(key, None)
+
+def transform_point(point, begin, end, length):
+	# like Sublime, a caret at the insertion point is pushed along
+	if point >= end:
+		return point + length - (end - begin)
+	if point > begin:
+		return begin + length
+	return point
+
+class FakeBuffer:
+	def __init__(self, view):
+		self.view = view
+
+	def primary_view(self):
+		return self.view
+
+class Editor:
+	# Calls the plugin the way Sublime does around a text command:
+	# on_text_command, the command, on_text_changed, on_modified and then
+	# on_post_text_command
+	def __init__(self, plugin):
+		self.plugin = plugin
+		self.listeners = []
+		self.change_listeners = {}
+		self.commands = {}
+		for value in vars(plugin).values():
+			if isinstance(value, type) and issubclass(value, sublime_plugin.TextCommand) and value.__module__ == plugin.__name__:
+				self.commands[get_command_name(value.__name__)] = value
+			if isinstance(value, type) and issubclass(value, sublime_plugin.EventListener) and value.__module__ == plugin.__name__:
+				self.listeners.append(value())
+
+	def add_view(self, view):
+		listener = self.plugin.RefactTextChangeListener()
+		listener.buffer = FakeBuffer(view)
+		self.change_listeners[view.id()] = listener
+
+	def activate(self, view):
+		for listener in self.listeners:
+			listener.on_activated(view)
+
+	def query_context(self, view, key):
+		return any(listener.on_query_context(view, key, None, True, True) for listener in self.listeners)
+
+	def run_command(self, view, name, args = None):
+		args = args or {}
+		for listener in self.listeners:
+			result = listener.on_text_command(view, name, args)
+			if result:
+				name, args = result[0], (result[1] if len(result) > 1 else {})
+
+		command = self.commands.get(name)
+		if command:
+			command(view).run(Edit(), **args)
+		else:
+			self.run_builtin(view, name, args)
+
+		changes = view.pending_changes
+		view.pending_changes = []
+		if changes:
+			self.change_listeners[view.id()].on_text_changed(changes)
+			for listener in self.listeners:
+				listener.on_modified(view)
+		for listener in self.listeners:
+			listener.on_post_text_command(view, name, args)
+
+	def run_builtin(self, view, name, args):
+		if name == "insert":
+			for region in list(view.sel()):
+				view.apply(region.begin(), region.end(), args["characters"])
+		elif name == "left_delete":
+			point = view.sel()[0].b
+			if point > 0:
+				view.apply(point - 1, point, "")
+		elif name == "replay_edit":
+			# an edit from a recording, the cursor ends up after it as if it was typed
+			if "range" in args:
+				row, col, end_row, end_col = args["range"]
+				begin, end = view.text_point(row, col, True), view.text_point(end_row, end_col, True)
+			else:
+				begin, end = 0, view.size()
+			view.apply(begin, end, args["text"])
+			view.sel().clear()
+			view.sel().add(sublime.Region(begin + len(args["text"])))
+		elif name == "move_to":
+			# "line" is not an argument of Sublime's move_to, it stands in for the
+			# click or goto that brought the cursor there
+			row = int(args.get("line", 0) * (len(view.line_starts) - 1))
+			point = view.line_end(row)
+			view.sel().clear()
+			view.sel().add(sublime.Region(point))
+
+def get_command_name(class_name):
+	if class_name.endswith("Command"):
+		class_name = class_name[:-len("Command")]
+	return re.sub("([a-z0-9])([A-Z])", r"\1_\2", class_name).lower()
+
+WORDS = ["value", "result", "items", "count", "index", "name", "config", "buffer", "total", "offset", "request", "response", "cache", "node", "parent", "key"]
+LINE_TEMPLATES = [
+	"{a} = {b}({c}, {d})",
+	"if {a} is not None and {b} > {n}:",
+	"for {a} in range(len({b})):",
+	"return {a}.{b}({c})",
+	"self.{a} = {b}",
+	"def {a}_{b}(self, {c}, {d} = None):",
+	"{a}.append({b}[{n}])",
+	"print(\"{a}\", {b})",
+]
+
+def make_line(rng):
+	return rng.choice(LINE_TEMPLATES).format(a = rng.choice(WORDS), b = rng.choice(WORDS), c = rng.choice(WORDS), d = rng.choice(WORDS), n = rng.randint(0, 100))
+
+def make_document(rng, lines):
+	result = []
+	indent = 0
+	for i in range(lines):
+		line = make_line(rng)
+		result.append("    " * indent + line)
+		if line.endswith(":"):
+			indent = min(indent + 1, 4)
+		elif indent > 0 and rng.random() < 0.3:
+			indent = indent - 1
+	return "\n".join(result) + "\n"
+
+def make_typist_events(rng, args):
+	# Bursts of keys at about args.rate keys/s with pauses in between, a new
+	# line every time one is finished, and now and then a switch to another tab
+	events = []
+	t = rng.uniform(0, 0.5)
+	view = 0
+	next_switch = 0
+	while t < args.duration:
+		if t >= next_switch:
+			view = rng.randrange(args.views)
+			events.append({"t": t, "view": view, "key": "goto", "line": rng.random()})
+			next_switch = t + rng.expovariate(1 / args.switch_every)
+			t = t + 0.5
+		events.append({"t": t, "view": view, "key": "enter"})
+		line = make_line(rng)
+		i = 0
+		while i < len(line) and t < args.duration:
+			burst = max(int(rng.expovariate(1 / args.burst)), 1)
+			for c in line[i:i + burst]:
+				t = t + rng.expovariate(args.rate)
+				if rng.random() < args.typo_rate:
+					events.append({"t": t, "view": view, "text": rng.choice(string.ascii_lowercase)})
+					t = t + rng.expovariate(args.rate)
+					events.append({"t": t, "view": view, "key": "backspace"})
+					t = t + rng.expovariate(args.rate)
+				events.append({"t": t, "view": view, "text": c})
+			i = i + burst
+			t = t + rng.lognormvariate(math.log(args.pause_ms / 1000), 0.5)
+			if rng.random() < args.accept_rate:
+				events.append({"t": t, "view": view, "key": "accept"})
+				t = t + 0.2
+	return events
+
+def make_pattern(rng, args):
+	events = []
+	for typist in range(args.typists):
+		events.extend(make_typist_events(random.Random(rng.random()), args))
+	events.sort(key = lambda event: event["t"])
+	return events
+
+class Simulator:
+	def __init__(self, plugin, views):
+		self.plugin = plugin
+		self.views = views
+		self.active = None
+		self.keys = 0
+		self.accepted = 0
+		self.late = 0
+		# every connection used during the run, the server may be restarted
+		self.connections = {}
+
+	def play(self, event):
+		view = self.views[event["view"]]
+		if not view is self.active:
+			self.active = view
+			editor.activate(view)
+		manager = self.plugin.refact_session_manager
+		if manager and manager.process.connection:
+			self.connections[id(manager.process.connection)] = manager.process.connection
+
+		self.keys = self.keys + 1
+		key = event.get("key")
+		if key is None:
+			if not view.skip_line:
+				view.run_command("insert", {"characters": event["text"]})
+		elif key == "enter":
+			view.skip_line = False
+			view.run_command("insert", {"characters": "\n"})
+		elif key == "backspace":
+			if not view.skip_line:
+				view.run_command("left_delete")
+		elif key == "accept":
+			if editor.query_context(view, "refact.show_completion"):
+				self.accepted = self.accepted + 1
+				view.run_command("refact_accept_completion")
+				view.skip_line = True
+		elif key == "escape":
+			if editor.query_context(view, "refact.show_completion"):
+				view.run_command("refact_clear_completion")
+		elif key == "edit":
+			view.skip_line = False
+			view.run_command("replay_edit", {"range": event["range"], "text": event["text"]} if "range" in event else {"text": event["text"]})
+		elif key == "goto":
+			view.skip_line = False
+			view.run_command("move_to", {"to": "eol", "line": event.get("line", 0)})
+
+	def replay(self, events, duration):
+		started = time.monotonic()
+		for event in events:
+			if event["t"] > duration:
+				break
+			delay = started + event["t"] - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+			main_loop.call(lambda event = event: self.play(event))
+		return time.monotonic() - started
+
+	def get_connection_stats(self):
+		totals = {}
+		for connection in self.connections.values():
+			stats = connection.get_stats() or {}
+			for key, value in stats.items():
+				totals[key] = totals.get(key, 0) + value
+		return totals
+
+def load_plugin():
+	# imported as the "refact" package, like Sublime does with the installed package
+	spec = importlib.util.spec_from_file_location("refact", os.path.join(PACKAGE_DIR, "__init__.py"), submodule_search_locations = [PACKAGE_DIR])
+	plugin = importlib.util.module_from_spec(spec)
+	sys.modules["refact"] = plugin
+	spec.loader.exec_module(plugin)
+	return plugin
+
+def get_file_name(uri):
+	if uri.startswith("file://"):
+		return urllib.parse.unquote(urllib.parse.urlparse(uri).path)
+	return uri
+
+def parse_value(text):
+	try:
+		return json.loads(text)
+	except ValueError:
+		return text
+
+def configure_server(args, settings):
+	if args.server_address:
+		settings.set("server_address", args.server_address)
+		return
+	if args.server_path:
+		settings.set("server_path", args.server_path)
+		return
+
+	config = {}
+	if args.fake_config:
+		with open(args.fake_config) as f:
+			config.update(json.load(f))
+	for key in ["latency_ms", "latency_distribution", "latency_spread", "drop_rate", "crash_after_requests"]:
+		if not getattr(args, key) is None:
+			config[key] = getattr(args, key)
+	config_file = tempfile.NamedTemporaryFile("w", suffix = ".json", delete = False)
+	json.dump(config, config_file)
+	config_file.close()
+	os.environ["REFACT_FAKE_LSP_CONFIG"] = config_file.name
+	settings.set("server_path", os.path.join(BENCHMARKS_DIR, "fake_refact_lsp.py"))
+
+def wait_ready(plugin):
+	deadline = time.monotonic() + READY_TIMEOUT
+	while time.monotonic() < deadline:
+		manager = plugin.refact_session_manager
+		if manager and manager.process.connection and manager.process.connection.is_ready():
+			return True
+		time.sleep(0.05)
+	return False
+
+def get_percentiles(histogram):
+	return "p50 %.2f, p95 %.2f, p99 %.2f, max %.2f ms" % tuple([histogram.get_percentile(p) / 1000 for p in [50, 95, 99]] + [histogram.max / 1000])
+
+def main():
+	parser = argparse.ArgumentParser(description = "load simulator for the refact plugin")
+	parser.add_argument("--views", type = int, default = 50, help = "open tabs")
+	parser.add_argument("--lines", type = int, default = 1000, help = "average lines per document")
+	parser.add_argument("--typists", type = int, default = 1, help = "views typed in at the same time")
+	parser.add_argument("--duration", type = float, default = 30, help = "seconds of typing")
+	parser.add_argument("--rate", type = float, default = 10, help = "keys per second within a burst")
+	parser.add_argument("--burst", type = float, default = 12, help = "average keys per burst")
+	parser.add_argument("--pause-ms", type = float, default = 600, help = "average pause between bursts")
+	parser.add_argument("--switch-every", type = float, default = 20, help = "average seconds before switching tabs")
+	parser.add_argument("--typo-rate", type = float, default = 0.03)
+	parser.add_argument("--accept-rate", type = float, default = 0.3, help = "how often a pause ends with tab")
+	parser.add_argument("--drain", type = float, default = 3, help = "seconds to wait for late responses")
+	parser.add_argument("--seed", type = int, default = 1)
+	parser.add_argument("--pattern", help = "replay typing from a JSON file instead of generating it")
+	parser.add_argument("--save-pattern", help = "write the typing to a JSON file")
+	parser.add_argument("--set", action = "append", default = [], metavar = "KEY=VALUE", help = "a refact.sublime-settings value, e.g. completion_debounce_ms=50")
+	parser.add_argument("--server-path", help = "refact-lsp binary to run")
+	parser.add_argument("--server-address", help = "connect to a running server")
+	parser.add_argument("--fake-config", help = "options for fake_refact_lsp.py, see that file")
+	parser.add_argument("--latency-ms", type = float)
+	parser.add_argument("--latency-distribution")
+	parser.add_argument("--latency-spread", type = float)
+	parser.add_argument("--drop-rate", type = float)
+	parser.add_argument("--crash-after-requests", type = int)
+	parser.add_argument("--json", help = "write the report to a JSON file")
+	parser.add_argument("--verbose", action = "store_true", help = "show what the plugin prints")
+	args = parser.parse_args()
+
+	if args.verbose:
+		return run(args)
+	with open(os.devnull, "w") as devnull:
+		with contextlib.redirect_stdout(devnull):
+			return run(args, sys.__stdout__)
+
+def run(args, out = None):
+	global editor, main_loop
+	out = out or sys.stdout
+
+	rng = random.Random(args.seed)
+	documents = None
+	if args.pattern:
+		with open(args.pattern) as f:
+			events = json.load(f)
+		if isinstance(events, dict):
+			documents = events["documents"]
+			events = events["events"]
+			args.views = len(documents)
+		args.views = max([args.views] + [event["view"] + 1 for event in events])
+	else:
+		events = make_pattern(rng, args)
+	if args.save_pattern:
+		with open(args.save_pattern, "w") as f:
+			json.dump(events, f)
+
+	settings = sublime.load_settings(REFACT_SETTINGS)
+	for item in args.set:
+		key, _, value = item.partition("=")
+		settings.set(key, parse_value(value))
+	configure_server(args, settings)
+
+	plugin = load_plugin()
+	from refact.src.perf_stats import perf_stats, Histogram
+	main_loop = Loop("main", Histogram())
+	async_loop = Loop("async", Histogram())
+	sublime.set_timeout = main_loop.call
+	sublime.set_timeout_async = async_loop.call
+
+	views = []
+	for i in range(args.views):
+		if documents and i < len(documents):
+			views.append(FakeView(i + 1, get_file_name(documents[i]["file_name"]), documents[i]["text"]))
+			continue
+		lines = max(int(rng.expovariate(1 / args.lines)), 10)
+		views.append(FakeView(i + 1, "/tmp/refact_load_sim/module_%d.py" % i, make_document(rng, lines)))
+	editor = Editor(plugin)
+	for view in views:
+		editor.add_view(view)
+
+	main_loop.call_wait(plugin.plugin_loaded)
+	if not wait_ready(plugin):
+		print("server did not come up within %ds" % READY_TIMEOUT, file = out)
+		return 1
+
+	simulator = Simulator(plugin, views)
+	elapsed = simulator.replay(events, args.duration)
+	time.sleep(args.drain)
+	manager = plugin.refact_session_manager
+	# sessions only exist for the views that were typed into
+	synced = main_loop.call_wait(lambda: sum(1 for session in manager.views.values() if session.is_synced()))
+
+	histograms = perf_stats.histograms
+	counters = perf_stats.counters
+	connection_stats = simulator.get_connection_stats()
+	summary = {
+		"views": args.views,
+		"sessions": len(manager.views),
+		"synced": synced,
+		"keys": simulator.keys,
+		"keys_per_second": simulator.keys / elapsed,
+		"accepted": simulator.accepted,
+		"requested": histograms["send"].count if "send" in histograms else 0,
+		"shown": histograms["total"].count if "total" in histograms else 0,
+		"cache_hits": counters.get("cache_hits", 0),
+		"stale_discarded": counters.get("stale_discarded", 0),
+		"timed_out": connection_stats.get("timeouts", 0),
+		"cancelled": connection_stats.get("cancelled", 0),
+		"late_responses": connection_stats.get("late_responses", 0),
+		"server_restarts": manager.process.restart_count,
+		"errors": main_loop.errors + async_loop.errors,
+	}
+	print("%(views)d views, %(sessions)d sessions, %(synced)d synced, %(keys)d keys at %(keys_per_second).1f keys/s, %(accepted)d completions accepted" % summary, file = out)
+	print("completions: %(requested)d requested, %(shown)d shown, %(cache_hits)d from cache, %(stale_discarded)d stale discarded, %(timed_out)d timed out, %(cancelled)d cancelled, %(late_responses)d late" % summary, file = out)
+	print("server restarts: %(server_restarts)d, callback errors: %(errors)d\n" % summary, file = out)
+	print(perf_stats.get_text(), file = out)
+	print("\nmain thread lag: %s, busy %.1f%%" % (get_percentiles(main_loop.lag), main_loop.busy / elapsed * 100), file = out)
+	print("async thread lag: %s, busy %.1f%%" % (get_percentiles(async_loop.lag), async_loop.busy / elapsed * 100), file = out)
+
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump({
+				"summary": summary,
+				"perf_stats": json.loads(perf_stats.to_json()),
+				"main_thread_lag": main_loop.lag.to_dict(),
+				"async_thread_lag": async_loop.lag.to_dict(),
+			}, f, indent = 2)
+
+	main_loop.call_wait(manager.shutdown)
+	return 1 if summary["errors"] else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
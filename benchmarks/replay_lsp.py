@@ -0,0 +1,341 @@
+# Replays traffic recorded with the "lsp_record_path" setting, so a real
+# editing session becomes a benchmark that runs without the source code
+# ever going to a live backend.
+#
+#   python benchmarks/replay_lsp.py info rec.lsp
+#   python benchmarks/replay_lsp.py endpoint rec.lsp --session 0 --speed 4
+#   python benchmarks/replay_lsp.py endpoint rec.lsp --server-command "benchmarks/fake_refact_lsp.py --latency-ms 80"
+#   python benchmarks/replay_lsp.py pattern rec.lsp typing.json && python benchmarks/load_sim.py --pattern typing.json
+#
+# endpoint sends what the plugin sent, at the recorded times divided by
+# --speed, through a fresh LspEndpoint. By default the server is a stand-in
+# that answers every request with its recorded response after its recorded
+# latency, divided by --speed as well. It reports per method latencies next to
+# the recorded ones divided by --speed, and how far behind schedule sending fell.
+#
+# pattern turns the documents and edits of a session into typing for
+# load_sim.py, which runs them through RefactSession with its own completion
+# requests.
+import os
+import sys
+import json
+import math
+import time
+import shlex
+import socket
+import argparse
+import threading
+import subprocess
+from collections import deque
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, ".."))
+
+from src.pylspclient.lsp_recorder import read_recording, SESSION, SENT, RECEIVED
+from src.pylspclient.json_rpc_endpoint import JsonRpcEndpoint
+from src.pylspclient.lsp_endpoint import LspEndpoint, PendingRequest
+from src.pylspclient.lsp_structs import ResponseError, ErrorCodes
+from src.pylspclient.io_loop import get_io_loop
+from src.perf_stats import Histogram
+
+PERCENTILES = [50, 95, 99]
+
+class Frame:
+	def __init__(self, direction, time, message):
+		self.direction = direction
+		self.time = time
+		self.message = message
+
+	def is_request(self):
+		return "method" in self.message and "id" in self.message
+
+	def is_notification(self):
+		return "method" in self.message and not "id" in self.message
+
+	def is_response(self):
+		return not "method" in self.message and "id" in self.message
+
+def load_sessions(path):
+	sessions = []
+	for frame in read_recording(path):
+		if frame.direction == SESSION:
+			sessions.append({"info": json.loads(frame.body), "frames": []})
+			continue
+		sessions[frame.session]["frames"].append(Frame(frame.direction, frame.time, json.loads(frame.body)))
+	return sessions
+
+def get_recorded_latencies(frames):
+	# recorded request id -> seconds until its response arrived
+	sent = {}
+	latencies = {}
+	for frame in frames:
+		if frame.direction == SENT and frame.is_request():
+			sent[frame.message["id"]] = frame.time
+		elif frame.direction == RECEIVED and frame.is_response() and frame.message["id"] in sent:
+			latencies[frame.message["id"]] = frame.time - sent.pop(frame.message["id"])
+	return latencies
+
+def get_percentiles(histogram):
+	if histogram.count == 0:
+		return "-"
+	return "/".join("%.1f" % (histogram.get_percentile(p) / 1000) for p in PERCENTILES)
+
+def info(args):
+	for index, session in enumerate(load_sessions(args.recording)):
+		frames = session["frames"]
+		methods = {}
+		for frame in frames:
+			if frame.direction == SENT and "method" in frame.message:
+				methods[frame.message["method"]] = methods.get(frame.message["method"], 0) + 1
+		duration = frames[-1].time if frames else 0
+		print("session %d: started %s, %.1fs, %d frames" % (index, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(session["info"]["started"])), duration, len(frames)))
+		for method, count in sorted(methods.items(), key = lambda item: -item[1]):
+			print("    %-32s %6d" % (method, count))
+
+class RecordedServer:
+	# Answers each request with the recorded response to the same method's
+	# request in the same position, after the recorded latency. Server
+	# notifications go out at their recorded times.
+	def __init__(self, frames, speed, sock):
+		self.speed = speed
+		self.sock = sock
+		self.endpoint = JsonRpcEndpoint(sock.makefile("wb"), sock.makefile("rb"))
+		self.requests = {}
+		self.notifications = []
+		responses = {}
+		for frame in frames:
+			if frame.direction == RECEIVED and frame.is_response():
+				responses[frame.message["id"]] = frame
+			elif frame.direction == RECEIVED and frame.is_notification():
+				self.notifications.append(frame)
+		for frame in frames:
+			if frame.direction == SENT and frame.is_request():
+				self.requests.setdefault(frame.message["method"], deque()).append((frame, responses.get(frame.message["id"])))
+		self.started = None
+
+	def start(self):
+		self.started = time.monotonic()
+		threading.Thread(target = self.run, daemon = True).start()
+		for frame in self.notifications:
+			self.send_later(frame.message, frame.time / self.speed - (time.monotonic() - self.started))
+
+	def send_later(self, message, delay):
+		timer = threading.Timer(max(delay, 0), lambda: self.send(message))
+		timer.daemon = True
+		timer.start()
+
+	def send(self, message):
+		try:
+			self.endpoint.send_request(message)
+		except (OSError, ValueError):
+			pass
+
+	def run(self):
+		while True:
+			message = self.endpoint.recv_response()
+			if message is None:
+				return
+			if not "method" in message or not "id" in message:
+				# notifications and $/cancelRequest: the recorded responses already reflect them
+				continue
+			recorded = self.requests.get(message["method"])
+			if not recorded:
+				self.send({"jsonrpc": "2.0", "id": message["id"], "result": None})
+				continue
+			request, response = recorded.popleft()
+			if response is None:
+				# never answered in the recording
+				continue
+			reply = dict(response.message)
+			reply["id"] = message["id"]
+			self.send_later(reply, (response.time - request.time) / self.speed)
+
+class Replay:
+	def __init__(self, endpoint, frames, speed):
+		self.endpoint = endpoint
+		self.frames = [frame for frame in frames if frame.direction == SENT]
+		self.speed = speed
+		self.recorded = get_recorded_latencies(frames)
+		self.histograms = {}
+		self.recorded_histograms = {}
+		self.outcomes = {}
+		self.lateness = Histogram()
+		self.handles = {}
+		self.futures = []
+		self.lock = threading.Lock()
+
+	def run(self):
+		started = time.monotonic()
+		for frame in self.frames:
+			due = started + frame.time / self.speed
+			delay = due - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+			self.lateness.record((time.monotonic() - due) * 1000000)
+			self.send(frame.message)
+		return time.monotonic() - started
+
+	def send(self, message):
+		method = message.get("method")
+		params = message.get("params")
+		params = params if isinstance(params, dict) else {}
+		if "id" in message and method:
+			handle = PendingRequest()
+			self.handles[message["id"]] = handle
+			sent = time.monotonic()
+			future = self.endpoint.call_method_async(method, pending_request = handle, **params)
+			future.add_done_callback(lambda future: self.on_done(method, message["id"], sent, future))
+			self.futures.append(future)
+			latency = self.recorded.get(message["id"])
+			if not latency is None:
+				# at --speed, so it compares with the replayed one
+				self.recorded_histograms.setdefault(method, Histogram()).record(latency / self.speed * 1000000)
+		elif method == "$/cancelRequest":
+			handle = self.handles.get(params.get("id"))
+			if handle:
+				handle.cancel()
+		elif method:
+			self.endpoint.send_notification(method, **params)
+
+	def on_done(self, method, rpc_id, sent, future):
+		latency = time.monotonic() - sent
+		self.handles.pop(rpc_id, None)
+		try:
+			future.result()
+			outcome = "ok"
+		except ResponseError as err:
+			outcome = "cancelled" if err.code == ErrorCodes.RequestCancelled else "error"
+		except TimeoutError:
+			# the recording ends before the response, shutdown usually
+			outcome = "timeout" if rpc_id in self.recorded else "unanswered"
+		except Exception:
+			outcome = "error"
+		with self.lock:
+			outcomes = self.outcomes.setdefault(method, {})
+			outcomes[outcome] = outcomes.get(outcome, 0) + 1
+			if outcome == "ok":
+				self.histograms.setdefault(method, Histogram()).record(latency * 1000000)
+
+	def wait(self, timeout):
+		deadline = time.monotonic() + timeout
+		for future in self.futures:
+			try:
+				future.exception(timeout = max(deadline - time.monotonic(), 0))
+			except Exception:
+				pass
+
+	def report(self, elapsed, duration):
+		print("replayed %d frames in %.2fs, %.2fs expected at %gx" % (len(self.frames), elapsed, duration / self.speed, self.speed))
+		print("sent behind schedule: p50/p95/p99 %s ms, max %.1f ms\n" % (get_percentiles(self.lateness), self.lateness.max / 1000))
+		print("%-28s %6s %6s %6s %6s %6s   %-20s %-20s" % ("method", "ok", "cancel", "tmout", "error", "unansw", "replayed p50/95/99", "recorded/%g p50/95/99" % self.speed))
+		for method in sorted(self.outcomes):
+			outcomes = self.outcomes[method]
+			replayed = self.histograms.get(method, Histogram())
+			recorded = self.recorded_histograms.get(method, Histogram())
+			print("%-28s %6d %6d %6d %6d %6d   %-20s %-20s" % (method, outcomes.get("ok", 0), outcomes.get("cancelled", 0), outcomes.get("timeout", 0), outcomes.get("error", 0), outcomes.get("unanswered", 0), get_percentiles(replayed), get_percentiles(recorded)))
+		print("\nunansw: requests the recording has no response for, such as a shutdown racing the end of the recording")
+
+def start_server(args, frames):
+	# returns the streams to talk to the server over
+	if args.server_command:
+		process = subprocess.Popen(shlex.split(args.server_command), stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+		return process.stdin, process.stdout
+	client, server = socket.socketpair()
+	RecordedServer(frames, args.speed, server).start()
+	return client.makefile("wb"), client.makefile("rb")
+
+def endpoint(args):
+	sessions = load_sessions(args.recording)
+	frames = sessions[args.session]["frames"]
+	if not frames:
+		print("session %d is empty" % args.session)
+		return 1
+	stdin, stdout = start_server(args, frames)
+	lsp_endpoint = LspEndpoint(JsonRpcEndpoint(stdin, stdout), timeout = args.timeout, io_loop = get_io_loop())
+	lsp_endpoint.start()
+
+	replay = Replay(lsp_endpoint, frames, args.speed)
+	elapsed = replay.run()
+	replay.wait(args.timeout + 1)
+	lsp_endpoint.stop()
+	replay.report(elapsed, frames[-1].time)
+	stats = lsp_endpoint.get_stats()
+	print("\nlate responses: %d, orphaned responses: %d" % (stats["late_responses"], stats["orphaned_responses"]))
+	return 0
+
+def pattern(args):
+	# The documents become the views of load_sim.py and every didChange an
+	# edit at its recorded time. Columns are UTF-16 in LSP and code points in
+	# load_sim, which only differ for text outside the BMP.
+	sessions = load_sessions(args.recording)
+	frames = sessions[args.session]["frames"]
+	views = {}
+	documents = []
+	events = []
+	for frame in frames:
+		if frame.direction != SENT or not frame.is_notification():
+			continue
+		method = frame.message["method"]
+		params = frame.message.get("params") or {}
+		if method == "textDocument/didOpen":
+			uri = params["textDocument"]["uri"]
+			if uri in views:
+				# opened again after a server restart
+				continue
+			views[uri] = len(documents)
+			documents.append({"file_name": uri, "text": params["textDocument"]["text"]})
+		elif method == "textDocument/didChange":
+			view = views.get(params["textDocument"]["uri"])
+			if view is None:
+				continue
+			for change in params["contentChanges"]:
+				event = {"t": frame.time, "view": view, "key": "edit", "text": change["text"]}
+				if change.get("range"):
+					start, end = change["range"]["start"], change["range"]["end"]
+					event["range"] = [start["line"], start["character"], end["line"], end["character"]]
+				events.append(event)
+	if events:
+		start = events[0]["t"] - 0.5
+		for event in events:
+			event["t"] = round((event["t"] - start) / args.speed, 4)
+	with open(args.output, "w") as f:
+		json.dump({"documents": documents, "events": events}, f)
+	print("%d documents, %d edits over %.1fs written to %s" % (len(documents), len(events), events[-1]["t"] if events else 0, args.output))
+
+	latencies = [latency for rpc_id, latency in get_recorded_latencies(frames).items() if latency > 0]
+	if latencies:
+		logs = [math.log(latency * 1000) for latency in latencies]
+		mean = sum(logs) / len(logs)
+		sigma = math.sqrt(sum((log - mean) ** 2 for log in logs) / len(logs))
+		print("recorded server latency fits --latency-ms %.0f --latency-distribution lognormal --latency-spread %.2f" % (math.exp(mean), sigma))
+	return 0
+
+def main():
+	parser = argparse.ArgumentParser(description = "replay lsp traffic recorded with lsp_record_path")
+	commands = parser.add_subparsers(dest = "command")
+	command = commands.add_parser("info", help = "list the sessions of a recording")
+	command.add_argument("recording")
+	command = commands.add_parser("endpoint", help = "replay a session through LspEndpoint")
+	command.add_argument("recording")
+	command.add_argument("--session", type = int, default = 0)
+	command.add_argument("--speed", type = float, default = 1, help = "2 replays twice as fast")
+	command.add_argument("--timeout", type = float, default = 2, help = "request timeout, as in the plugin")
+	command.add_argument("--server-command", help = "run this server instead of replaying the recorded responses")
+	command = commands.add_parser("pattern", help = "write the edits of a session as typing for load_sim.py")
+	command.add_argument("recording")
+	command.add_argument("output")
+	command.add_argument("--session", type = int, default = 0)
+	command.add_argument("--speed", type = float, default = 1)
+	args = parser.parse_args()
+
+	if args.command == "info":
+		return info(args)
+	if args.command == "endpoint":
+		return endpoint(args)
+	if args.command == "pattern":
+		return pattern(args)
+	parser.print_help()
+	return 1
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,113 @@
+# Just enough of Sublime Text's sublime module to import the plugin outside
+# the editor. Only the benchmarks put this directory on sys.path.
+
+def set_timeout(callback, delay = 0):
+	callback()
+
+set_timeout_async = set_timeout
+
+def status_message(message):
+	pass
+
+def packages_path():
+	return ""
+
+def windows():
+	return []
+
+class Settings(dict):
+	def get(self, key, default = None):
+		return dict.get(self, key, default)
+
+	def set(self, key, value):
+		self[key] = value
+
+	def add_on_change(self, key, callback):
+		pass
+
+	def clear_on_change(self, key):
+		pass
+
+settings = {}
+
+def load_settings(name):
+	return settings.setdefault(name, Settings())
+
+def save_settings(name):
+	pass
+
+class Region:
+	def __init__(self, a, b = None):
+		self.a = a
+		self.b = a if b is None else b
+
+	def __eq__(self, other):
+		return isinstance(other, Region) and self.a == other.a and self.b == other.b
+
+	def __len__(self):
+		return abs(self.b - self.a)
+
+	def __repr__(self):
+		return "Region(%d, %d)" % (self.a, self.b)
+
+	def begin(self):
+		return min(self.a, self.b)
+
+	def end(self):
+		return max(self.a, self.b)
+
+	def empty(self):
+		return self.a == self.b
+
+	def contains(self, x):
+		if isinstance(x, Region):
+			return self.begin() <= x.begin() and x.end() <= self.end()
+		return self.begin() <= x <= self.end()
+
+	def intersects(self, rhs):
+		lb, le, rb, re = self.begin(), self.end(), rhs.begin(), rhs.end()
+		return (lb == rb and le == re) or rb > lb and rb < le or re > lb and re < le or lb > rb and lb < re or le > rb and le < re
+
+class HistoricPosition:
+	def __init__(self, pt, row, col, col_utf16, col_utf8):
+		self.pt = pt
+		self.row = row
+		self.col = col
+		self.col_utf16 = col_utf16
+		self.col_utf8 = col_utf8
+
+class TextChange:
+	def __init__(self, a, b, len_utf16, len_utf8, str):
+		self.a = a
+		self.b = b
+		self.len_utf16 = len_utf16
+		self.len_utf8 = len_utf8
+		self.str = str
+
+class Syntax:
+	def __init__(self, path, name, hidden, scope):
+		self.path = path
+		self.name = name
+		self.hidden = hidden
+		self.scope = scope
+
+class PhantomLayout:
+	INLINE = 1
+	BELOW = 2
+	BLOCK = 4
+
+class Phantom:
+	def __init__(self, region, content, layout):
+		self.region = region
+		self.content = content
+		self.layout = layout
+
+class PhantomSet:
+	def __init__(self, view, key = ""):
+		self.phantoms = []
+
+	def update(self, phantoms):
+		self.phantoms = phantoms
+
+class PopupFlags:
+	HIDE_ON_CHARACTER_EVENT = 4
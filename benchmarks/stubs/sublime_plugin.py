@@ -0,0 +1,18 @@
+# Base classes the plugin derives from, see sublime.py next to this file.
+
+class EventListener:
+	pass
+
+class ViewEventListener:
+	pass
+
+class TextChangeListener:
+	pass
+
+class TextCommand:
+	def __init__(self, view):
+		self.view = view
+
+class WindowCommand:
+	def __init__(self, window):
+		self.window = window
@@ -0,0 +1,208 @@
+# Microbenchmarks of the plugin's hot paths, run outside Sublime Text with the
+# stub sublime module from benchmarks/stubs.
+#
+#   python benchmarks/suite.py                       run everything
+#   python benchmarks/suite.py html                  only cases whose name contains "html"
+#   python benchmarks/suite.py --save base.json      store the results as a baseline
+#   python benchmarks/suite.py --compare base.json   fail if a case got slower than the baseline
+#
+# Per op it reports the best time over several repeats, the peak memory
+# traced while running one op, and the memory blocks still allocated
+# after it (a growing number points at a leak or a cache).
+import os
+import io
+import sys
+import json
+import time
+import timeit
+import argparse
+import threading
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "stubs"))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, ".."))
+
+from src.pylspclient.json_rpc_endpoint import JsonRpcEndpoint, MyEncoder, encode_message
+from src.pylspclient.lsp_structs import *
+from src.completion_text import get_completion_text, find_diff
+from src.phantom_state import html_prepare, render_inline_template
+
+DEFAULT_THRESHOLD = 0.1
+URI = "file:///home/user/project/src/module.py"
+
+class NullSink(io.RawIOBase):
+	# a pipe whose reader never falls behind
+	def writable(self):
+		return True
+
+	def write(self, data):
+		return len(data)
+
+def drained_pipe():
+	# flushes cost a real write syscall here, which NullSink hides
+	read_fd, write_fd = os.pipe()
+	def drain():
+		while os.read(read_fd, 1 << 16):
+			pass
+	threading.Thread(target = drain, daemon = True).start()
+	return os.fdopen(write_fd, "wb")
+
+def make_document(lines):
+	return "\n".join("    result_%d = compute(value_%d, 'text') # comment" % (i, i) for i in range(lines))
+
+def make_completion(lines):
+	return "\n".join("\tif value_%d is not None:\n\t\treturn value_%d * 2  # <%d>" % (i, i, i) for i in range(lines // 2))
+
+def get_completions_message():
+	return {
+		"jsonrpc": "2.0",
+		"id": 1,
+		"method": "refact/getCompletions",
+		"params": {
+			"textDocument": TextDocumentIdentifier(URI),
+			"position": Position(120, 5),
+			"parameters": {"max_new_tokens": 20, "temperature": 0.1},
+			"multiline": False,
+		}
+	}
+
+def did_change_message(text):
+	return {
+		"jsonrpc": "2.0",
+		"method": "textDocument/didChange",
+		"params": {
+			"textDocument": VersionedTextDocumentIdentifier(URI, 42),
+			"contentChanges": [TextDocumentContentChangeEvent(None, None, text)],
+		}
+	}
+
+def incremental_change_message():
+	change = TextDocumentContentChangeEvent(Range(Position(120, 4), Position(120, 4)), 0, "a")
+	return {
+		"jsonrpc": "2.0",
+		"method": "textDocument/didChange",
+		"params": {"textDocument": VersionedTextDocumentIdentifier(URI, 42), "contentChanges": [change]}
+	}
+
+def completion_response():
+	return {"jsonrpc": "2.0", "id": 1, "result": {"choices": [{"code_completion": "compute(value, 'text')  # done"}]}}
+
+def frame(message):
+	body = json.dumps(message, cls = MyEncoder).encode()
+	return b"Content-Length: %d\r\n\r\n" % len(body) + body
+
+def send_case(message):
+	endpoint = JsonRpcEndpoint(io.BufferedWriter(NullSink()), None)
+	return lambda: endpoint.send_request(message)
+
+def batch_case(message, count, batched):
+	endpoint = JsonRpcEndpoint(drained_pipe(), None)
+	def send():
+		for i in range(count):
+			endpoint.send_request(message)
+	if not batched:
+		return send
+	def send_batched():
+		with endpoint.batch():
+			send()
+	return send_batched
+
+def recv_case(message, count):
+	data = frame(message) * count
+	def recv():
+		endpoint = JsonRpcEndpoint(None, io.BufferedReader(io.BytesIO(data)))
+		while not endpoint.recv_response() is None:
+			pass
+	return recv
+
+# name, op factory, messages or calls per op
+CASES = [
+	("rpc send getCompletions", lambda: send_case(get_completions_message()), 1),
+	("rpc send didChange 500 lines", lambda: send_case(did_change_message(make_document(500))), 1),
+	("rpc send didChange 20k lines", lambda: send_case(did_change_message(make_document(20000))), 1),
+	("rpc send 10 small, flush each", lambda: batch_case(did_change_message("x = 1"), 10, False), 10),
+	("rpc send 10 small, one flush", lambda: batch_case(did_change_message("x = 1"), 10, True), 10),
+	("rpc recv 100 responses", lambda: recv_case(completion_response(), 100), 100),
+	("rpc recv 10 didChange 500 lines", lambda: recv_case(did_change_message(make_document(500)), 10), 10),
+	("encode getCompletions", lambda: (lambda message: lambda: encode_message(message))(get_completions_message()), 1),
+	("encode didChange incremental", lambda: (lambda message: lambda: encode_message(message))(incremental_change_message()), 1),
+	("encode MyEncoder didChange 500", lambda: (lambda message: lambda: json.dumps(message, cls = MyEncoder))(did_change_message(make_document(500))), 1),
+	("completion_text mid line", lambda: lambda: get_completion_text(0, "    result = compute(value, 'text')  # comment", "    result = comp", 17), 1),
+	("completion_text blank line", lambda: lambda: get_completion_text(0, "\t\treturn compute(value)", "\t\t", 2, 4), 1),
+	("completion_text no match", lambda: lambda: get_completion_text(0, "    result = compute(value)", "    other = 1", 13), 1),
+	("find_diff long line", lambda: lambda: find_diff("x" * 60 + " = compute(a, b, c)  # " + "y" * 60, "x" * 60 + " = compute(a, b"), 1),
+	("html_prepare 2 lines", lambda: (lambda text: lambda: html_prepare(text, 4))(make_completion(2)), 1),
+	("html_prepare 60 lines", lambda: (lambda text: lambda: html_prepare(text, 4))(make_completion(60)), 1),
+	("inline template 60 lines cached", lambda: (lambda text: lambda: render_inline_template(text, 4))(make_completion(60)), 1),
+]
+
+def count_blocks_kept(op):
+	before = sys.getallocatedblocks()
+	op()
+	return sys.getallocatedblocks() - before
+
+def measure(op, per, min_time = 0.2, repeat = 5):
+	op()
+	number = 1
+	while True:
+		elapsed = timeit.timeit(op, number = number)
+		if elapsed >= min_time / repeat:
+			break
+		number = number * 2
+	best = min(timeit.repeat(op, number = number, repeat = repeat)) / number
+
+	blocks_kept = max(count_blocks_kept(op) - count_blocks_kept(lambda: None), 0)
+
+	tracemalloc.start()
+	op()
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return {"us_per_op": best / per * 1e6, "peak_bytes": peak, "blocks_kept": blocks_kept}
+
+def run(pattern):
+	results = {}
+	print("%-34s %12s %12s %12s" % ("case", "us/op", "peak B", "blocks kept"))
+	for name, make_op, per in CASES:
+		if pattern and not pattern in name:
+			continue
+		result = measure(make_op(), per)
+		results[name] = result
+		print("%-34s %12.3f %12d %12d" % (name, result["us_per_op"], result["peak_bytes"], result["blocks_kept"]))
+	return results
+
+def compare(results, baseline, threshold):
+	regressions = []
+	print("\n%-34s %12s %12s %8s" % ("case", "base us/op", "now us/op", "ratio"))
+	for name, result in results.items():
+		if not name in baseline:
+			print("%-34s %12s %12.3f" % (name, "-", result["us_per_op"]))
+			continue
+		before = baseline[name]["us_per_op"]
+		ratio = result["us_per_op"] / before
+		flag = ""
+		if ratio > 1 + threshold:
+			flag = "  SLOWER"
+			regressions.append(name)
+		print("%-34s %12.3f %12.3f %7.2fx%s" % (name, before, result["us_per_op"], ratio, flag))
+	return regressions
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "refact-sublime microbenchmarks")
+	parser.add_argument("pattern", nargs = "?", default = "", help = "only run cases whose name contains this")
+	parser.add_argument("--save", metavar = "FILE", help = "write the results to FILE as a baseline")
+	parser.add_argument("--compare", metavar = "FILE", help = "compare with a baseline written by --save")
+	parser.add_argument("--threshold", type = float, default = DEFAULT_THRESHOLD, help = "slowdown counted as a regression, 0.1 is 10%%")
+	args = parser.parse_args()
+
+	results = run(args.pattern)
+	if args.save:
+		with open(args.save, "w") as f:
+			json.dump({"python": sys.version, "time": time.time(), "results": results}, f, indent = 2)
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)["results"]
+		regressions = compare(results, baseline, args.threshold)
+		if regressions:
+			print("\n%d case(s) slower than the baseline by more than %d%%" % (len(regressions), args.threshold * 100))
+			sys.exit(1)
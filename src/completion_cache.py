@@ -0,0 +1,50 @@
+import threading
+from collections import OrderedDict
+
+class CompletionCache:
+	# Bounded LRU of completions, keyed on the document and a hash of the text
+	# around the cursor, so a context seen before (undo, retyping a word,
+	# returning to a line) is answered without a round-trip to the server.
+	def __init__(self, max_entries = 256, max_bytes = 1024 * 1024):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.entries = OrderedDict()
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	def make_key(self, file_name, pos, multiline, context):
+		return (file_name, pos[1], multiline, hash(context))
+
+	def entry_size(self, key, completions):
+		return len(key[0]) + sum(len(completion) for completion in completions)
+
+	def get(self, key):
+		with self.lock:
+			completions = self.entries.get(key)
+			if completions is None:
+				self.misses = self.misses + 1
+				return None
+			self.entries.move_to_end(key)
+			self.hits = self.hits + 1
+			return completions
+
+	def put(self, key, completions):
+		size = self.entry_size(key, completions)
+		if self.max_entries <= 0 or size > self.max_bytes:
+			return
+
+		with self.lock:
+			if key in self.entries:
+				self.size = self.size - self.entry_size(key, self.entries.pop(key))
+			self.entries[key] = completions
+			self.size = self.size + size
+			while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+				old_key, old_completions = self.entries.popitem(last = False)
+				self.size = self.size - self.entry_size(old_key, old_completions)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.size = 0
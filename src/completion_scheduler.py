@@ -0,0 +1,67 @@
+import sublime
+import time
+
+def now_ms():
+	return time.monotonic() * 1000
+
+class CompletionScheduler:
+	# Collapses a burst of completion triggers into a single request.
+	# The request fires once the user has been idle for debounce_ms, or at the
+	# latest max_wait_ms after the first trigger of the burst.
+	def __init__(self, fire, debounce_ms = 0, max_wait_ms = 0):
+		self.fire = fire
+		self.debounce_ms = debounce_ms
+		self.max_wait_ms = max_wait_ms
+		self.pending = False
+		self.waiting = False
+		self.timer_armed = False
+		self.burst_start = 0
+		self.last_trigger = 0
+
+	def schedule(self):
+		if self.debounce_ms <= 0:
+			self.run()
+			return
+
+		now = now_ms()
+		if not self.pending:
+			self.pending = True
+			self.burst_start = now
+		self.last_trigger = now
+		if not self.timer_armed:
+			self.arm(self.debounce_ms)
+
+	def cancel(self):
+		self.pending = False
+		self.waiting = False
+
+	def idle(self):
+		# the previous request finished, run one that had to wait for it
+		if self.waiting and not self.pending:
+			self.waiting = False
+			self.run()
+
+	def arm(self, delay):
+		self.timer_armed = True
+		sublime.set_timeout(self.on_timer, max(int(delay), 1))
+
+	def on_timer(self):
+		self.timer_armed = False
+		if not self.pending:
+			return
+
+		now = now_ms()
+		quiet = now - self.last_trigger
+		waited = now - self.burst_start
+		if quiet >= self.debounce_ms or (self.max_wait_ms > 0 and waited >= self.max_wait_ms):
+			self.pending = False
+			self.run()
+			return
+
+		delay = self.debounce_ms - quiet
+		if self.max_wait_ms > 0:
+			delay = min(delay, self.max_wait_ms - waited)
+		self.arm(delay)
+
+	def run(self):
+		self.waiting = not self.fire()
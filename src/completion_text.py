@@ -43,11 +43,11 @@ def collect_space(s, index):
 		index = index - 1
 	return space
 
-def get_completion_text(point, text, line, end = None):
+def get_completion_text(point, text, line, end = None, tab_size = 4):
 	if not line or line.isspace():
-		s = replace_tab(text)
+		s = replace_tab(text, tab_size)
 		res_space = get_nonwhitespace(s)
-		l = replace_tab(line)
+		l = replace_tab(line, tab_size)
 		diff = res_space - len(l)
 		if diff > 0:
 			return s[(res_space - diff):]
@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+
+# values below 2 ** SUB_BUCKET_BITS microseconds get a bucket each, above that
+# every power of two is split into 2 ** (SUB_BUCKET_BITS - 1) buckets, which
+# keeps the error of a reported value around 3% whatever its magnitude
+SUB_BUCKET_BITS = 5
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+PERCENTILES = [50, 95, 99]
+
+# in the order a completion goes through them
+STAGES = [
+	"debounce",       # last keystroke until the request fires
+	"queue",          # waiting for the async worker
+	"prepare",        # cursor state, context hash and cache lookup
+	"send",           # encoding and writing the request
+	"server",         # request written until the response arrived
+	"request",        # get_completions_async until its future resolved
+	"dispatch",       # response until the async worker handled it
+	"render",         # handing over to the main thread and showing the phantoms
+	"phantom_update", # every PhantomState.update, typing through included
+	"total",          # last keystroke until the phantoms are shown
+]
+
+def get_bucket(value):
+	if value < SUB_BUCKET_COUNT:
+		return value
+	shift = value.bit_length() - SUB_BUCKET_BITS
+	return shift * SUB_BUCKET_HALF + (value >> shift)
+
+def get_bucket_range(bucket):
+	if bucket < SUB_BUCKET_COUNT:
+		return bucket, bucket
+	shift = bucket // SUB_BUCKET_HALF - 1
+	mantissa = bucket % SUB_BUCKET_HALF + SUB_BUCKET_HALF
+	return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+class Histogram:
+	# HDR style histogram of durations in microseconds: log-linear buckets
+	# counted in a dict, so recording is O(1) and memory stays small however
+	# many values go in.
+	def __init__(self):
+		self.counts = {}
+		self.count = 0
+		self.total = 0
+		self.min = None
+		self.max = 0
+
+	def record(self, value):
+		value = max(int(value), 0)
+		bucket = get_bucket(value)
+		self.counts[bucket] = self.counts.get(bucket, 0) + 1
+		self.count = self.count + 1
+		self.total = self.total + value
+		self.max = max(self.max, value)
+		self.min = value if self.min is None else min(self.min, value)
+
+	def get_percentile(self, percentile):
+		if self.count == 0:
+			return 0
+		rank = max(int(round(percentile / 100 * self.count)), 1)
+		seen = 0
+		for bucket in sorted(self.counts):
+			seen = seen + self.counts[bucket]
+			if seen >= rank:
+				low, high = get_bucket_range(bucket)
+				return min((low + high) // 2, self.max)
+		return self.max
+
+	def get_mean(self):
+		return self.total / self.count if self.count else 0
+
+	def to_dict(self):
+		return {
+			"count": self.count,
+			"min_ms": (self.min or 0) / 1000,
+			"mean_ms": self.get_mean() / 1000,
+			"max_ms": self.max / 1000,
+			"percentiles_ms": {"p%d" % p: self.get_percentile(p) / 1000 for p in PERCENTILES},
+			# [lowest, highest] microseconds of a bucket and how many values fell in it
+			"buckets": [[get_bucket_range(bucket)[0], get_bucket_range(bucket)[1], self.counts[bucket]] for bucket in sorted(self.counts)],
+		}
+
+class PerfStats:
+	def __init__(self):
+		self.histograms = {}
+		# events without a duration, like completions thrown away
+		self.counters = {}
+		self.started = time.time()
+		self.lock = threading.Lock()
+
+	def record(self, stage, seconds):
+		with self.lock:
+			histogram = self.histograms.get(stage)
+			if histogram is None:
+				histogram = Histogram()
+				self.histograms[stage] = histogram
+			histogram.record(seconds * 1000000)
+
+	def count(self, name):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + 1
+
+	def get_stages(self):
+		known = [stage for stage in STAGES if stage in self.histograms]
+		return known + sorted(stage for stage in self.histograms if not stage in STAGES)
+
+	def get_text(self):
+		with self.lock:
+			lines = ["%-16s %8s %10s %10s %10s %10s" % ("stage", "count", "p50 ms", "p95 ms", "p99 ms", "max ms")]
+			for stage in self.get_stages():
+				histogram = self.histograms[stage]
+				percentiles = [histogram.get_percentile(p) / 1000 for p in PERCENTILES]
+				lines.append("%-16s %8d %10.2f %10.2f %10.2f %10.2f" % tuple([stage, histogram.count] + percentiles + [histogram.max / 1000]))
+			counters = sorted(self.counters.items())
+		if len(lines) == 1:
+			lines.append("no completions yet")
+		for name, value in counters:
+			lines.append("%-16s %8d" % (name, value))
+		return "\n".join(lines)
+
+	def to_json(self):
+		with self.lock:
+			stages = {stage: self.histograms[stage].to_dict() for stage in self.get_stages()}
+			counters = dict(self.counters)
+		return json.dumps({"since": self.started, "stages": stages, "counters": counters}, indent = 2)
+
+perf_stats = PerfStats()
+
+class CompletionTrace:
+	# Follows one completion through its stages, each mark records the time
+	# since the previous one
+	def __init__(self, started):
+		self.started = started
+		self.last = started
+
+	def mark(self, stage):
+		now = time.monotonic()
+		perf_stats.record(stage, now - self.last)
+		self.last = now
+
+	def finish(self):
+		perf_stats.record("total", time.monotonic() - self.started)
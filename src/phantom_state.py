@@ -3,13 +3,20 @@ import traceback
 import sublime
 import sublime_plugin
 import html
+import functools
+import time
 from .utils import *
 from .completion_text import get_completion_text
+from .settings import get_view_setting
+from .perf_stats import perf_stats
 from dataclasses import dataclass
 from typing import NamedTuple
 
 Direction = Enum('Direction', ['inline', 'previous'])
 
+# rendered HTML for recent texts, a completion is redrawn with the same text on most keystrokes
+TEMPLATE_CACHE_SIZE = 64
+
 class PhantomInsertion(NamedTuple):
 	location: int
 	text: str
@@ -98,30 +105,15 @@ class AddedSpace():
 	def remove_space(self, view):
 		view.run_command("refact_clear_space", {'position' : self.get_line(view).b})
 
-class PhantomState:
-	def __init__(self, view):
-		self.phantomSet = sublime.PhantomSet(view)
-		self.added_space = None
-		self.seeds = []
-		self.view = view
-		self.update_step = False
-		self.phantoms_visible = False
-		s = sublime.load_settings("Preferences.sublime-settings")
-		self.tab_size = s.get("tab_size", 4)
-
-	invisibleDiv = """
-	<body id="invisible-div">
-		<style>
-			html, body {
-				line-height: 0;
-				margin-top: 0;
-			}
-		</style>
-	</body>
-	"""
+def html_prepare(s, tab_size):
+	s = s.replace('\t', ' ' * tab_size)
+	res = "<br>".join([html.escape(s) for s in s.split('\n')])
+	res = res.replace(" ", "&nbsp;")
+	return res
 
-	def create_inline_template(self, text):
-		return """
+@functools.lru_cache(maxsize = TEMPLATE_CACHE_SIZE)
+def render_inline_template(text, tab_size):
+	return """
 		<body id="inline-div">
 			<style>
 				html, body {
@@ -134,12 +126,13 @@ class PhantomState:
 				}
 			</style>
 
-			""" + self.html_prepare(text) + """
+			""" + html_prepare(text, tab_size) + """
 		</body>
 		"""
-	
-	def create_annotation_template(self, text):
-		return """
+
+@functools.lru_cache(maxsize = TEMPLATE_CACHE_SIZE)
+def render_annotation_template(text, tab_size):
+	return """
 		<body id="line-annotation">
 			<style>
 				html, body {
@@ -149,15 +142,46 @@ class PhantomState:
 				}
 			</style>
 
-			""" + self.html_prepare(text) + """
+			""" + html_prepare(text, tab_size) + """
 		</body>
 		"""
 
-	def html_prepare(self, s):
-		s = s.replace('\t', ' ' * self.tab_size)
-		res = "<br>".join([html.escape(s) for s in s.split('\n')])
-		res = res.replace(" ", "&nbsp;")
-		return res
+class PhantomState:
+	def __init__(self, view):
+		self.phantomSet = sublime.PhantomSet(view)
+		self.added_space = None
+		self.seeds = []
+		self.view = view
+		self.update_step = False
+		self.phantoms_visible = False
+		# what the phantom set currently shows, to skip updates that change nothing
+		self.shown_phantoms = None
+		self.shown_change_count = None
+		self.tab_size = get_view_setting(view, "tab_size", 4)
+		view.settings().add_on_change("refact.tab_size", self.on_view_settings_change)
+
+	def on_view_settings_change(self):
+		self.tab_size = get_view_setting(self.view, "tab_size", 4)
+
+	def close(self):
+		self.view.settings().clear_on_change("refact.tab_size")
+
+	invisibleDiv = """
+	<body id="invisible-div">
+		<style>
+			html, body {
+				line-height: 0;
+				margin-top: 0;
+			}
+		</style>
+	</body>
+	"""
+
+	def create_inline_template(self, text):
+		return render_inline_template(text, self.tab_size)
+	
+	def create_annotation_template(self, text):
+		return render_annotation_template(text, self.tab_size)
 
 	def create_inline_phantom(self, a, b, text):
 		region = sublime.Region(a,b)
@@ -183,10 +207,17 @@ class PhantomState:
 
 	def add_phantoms(self, new_phantoms):
 		view = self.view
-		cursor_position = view.sel()[0]
+		shown_phantoms = tuple((phantom.region.a, phantom.region.b, phantom.content, phantom.layout) for phantom in new_phantoms)
+		change_count = view.change_count()
+		# an edit may have moved the phantoms shown, then only PhantomSet knows where they are
+		if shown_phantoms == self.shown_phantoms and (not shown_phantoms or change_count == self.shown_change_count):
+			return
 
-		self.phantomSet.update([])
+		cursor_position = view.sel()[0]
+		# PhantomSet.update keeps the phantoms that compare equal and only adds or erases the others
 		self.phantomSet.update(new_phantoms)
+		self.shown_phantoms = shown_phantoms
+		self.shown_change_count = change_count
 		if get_cursor_point(view) != cursor_position.b:
 			set_cursor_position(view, cursor_position)
 
@@ -194,7 +225,7 @@ class PhantomState:
 		cursor_point = get_cursor_point(self.view)
 		line_text = get_line(self.view, cursor_point)
 		rc = self.view.rowcol(cursor_point)
-		completion_text = get_completion_text(cursor_point, seed.get_cursor_text(), line_text[:rc[1]], rc[1])
+		completion_text = get_completion_text(cursor_point, seed.get_cursor_text(), line_text[:rc[1]], rc[1], self.tab_size)
 		return completion_text
 
 	def add_space(self, popup_type):
@@ -220,6 +251,9 @@ class PhantomState:
 
 		completion_text = self.get_seed_completion_text(seed)
 		popup_type = line.a == cursor_point
+		if completion_text is not None and len(completion_text) == 0 and seed.next_line_phantom:
+			# first line typed in full, keep showing the lines below it
+			return [completion_text, popup_type]
 		if completion_text and (not popup_type or line.a > 0):
 			return [completion_text, popup_type]
 		else:
@@ -244,7 +278,7 @@ class PhantomState:
 		step_phantoms =[]
 		next_inline_phantom = seed.next_inline_phantom
 		next_line_phantom = seed.next_line_phantom
-		if not completion_text.isspace():
+		if completion_text and not completion_text.isspace():
 			if popup_type:
 				self.show_start_line_completion(cursor_point, completion_text)
 			else:
@@ -262,6 +296,7 @@ class PhantomState:
 		return step_phantoms
 
 	def update(self):
+		started = time.monotonic()
 		self.update_step = True
 		self.view.hide_popup()
 		phantoms = []
@@ -277,6 +312,32 @@ class PhantomState:
 		else:
 			self.clear_phantoms()
 		self.update_step = False
+		perf_stats.record("phantom_update", time.monotonic() - started)
+
+	def advance_seed(self):
+		# the first line of a multiline suggestion was typed in full and the
+		# cursor moved on to the next line, continue with the lines below it
+		if len(self.seeds) != 1:
+			return None
+
+		seed = self.seeds[0]
+		if not seed.next_line_phantom:
+			return None
+
+		view = self.view
+		cursor_point = get_cursor_point(view)
+		row = view.rowcol(cursor_point)[0]
+		if row != seed.cursor_phantom.line + 1:
+			return None
+
+		previous_line = get_line(view, view.text_point(row - 1, 0))
+		rest = get_completion_text(cursor_point, seed.get_cursor_text(), previous_line, len(previous_line), self.tab_size)
+		if rest is None or not rest.isspace() and len(rest) > 0:
+			return None
+
+		text = seed.next_line_phantom.text[1:]
+		self.seeds = filter_none([self.create_seed([PhantomInsertion(view.line(cursor_point).a, text)])])
+		return text
 
 	def create_seed(self, phantom_block):
 		seed = Seed(self.view, phantom_block)
@@ -291,7 +352,7 @@ class PhantomState:
 	def clear_phantoms(self):
 		self.phantoms_visible = False
 		self.view.hide_popup()
-		self.phantomSet.update([])
+		self.add_phantoms([])
 		self.remove_space()
 
 	# phantom_insertions is [point, text]
@@ -0,0 +1,149 @@
+from __future__ import print_function
+import os
+import socket
+import selectors
+import threading
+import time
+import traceback
+
+
+class IoLoop(object):
+    '''
+    A single thread serving any number of connections. It waits on all their streams with a selector, reads what
+    each one has available without blocking on the others, and sweeps expired requests, so an idle connection
+    costs no thread of its own.
+    '''
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.changes = []
+        self.timed = set()
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ, None)
+        self.thread = None
+
+
+    @staticmethod
+    def supports(stream):
+        '''
+        Checks if the stream can be waited on. Windows can only select on sockets.
+
+        :param stream: A readable binary stream.
+        '''
+        try:
+            stream.fileno()
+        except (AttributeError, OSError, ValueError):
+            return False
+        if os.name == "nt":
+            return isinstance(getattr(stream, "raw", stream), socket.SocketIO)
+        return True
+
+
+    def add_reader(self, stream, callback):
+        '''
+        Calls callback on the loop thread whenever stream has data. The callback must read from the stream at
+        most once per call and returns False to stop watching it.
+
+        :param stream: A readable binary stream.
+        :param callable callback: Called without arguments.
+        '''
+        self.change(lambda: self.selector.register(stream, selectors.EVENT_READ, callback))
+
+
+    def remove_reader(self, stream):
+        self.change(lambda: self.unregister(stream))
+
+
+    def add_timed(self, source):
+        '''
+        Registers an object with next_deadline() and sweep() methods. sweep() is called once the deadline
+        returned by next_deadline() has passed.
+        '''
+        self.change(lambda: self.timed.add(source))
+
+
+    def remove_timed(self, source):
+        self.change(lambda: self.timed.discard(source))
+
+
+    def change(self, change):
+        # the selector is only touched from the loop thread
+        with self.lock:
+            self.changes.append(change)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="refact-io-loop", daemon=True)
+                self.thread.start()
+        self.wake()
+
+
+    def wake(self):
+        try:
+            self.wake_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            # a wakeup is pending already
+            pass
+
+
+    def unregister(self, stream):
+        try:
+            self.selector.unregister(stream)
+        except (KeyError, ValueError):
+            pass
+
+
+    def apply_changes(self):
+        with self.lock:
+            changes = self.changes
+            self.changes = []
+        for change in changes:
+            try:
+                change()
+            except (KeyError, ValueError, OSError) as err:
+                print("io loop change failed", err)
+
+
+    def get_timeout(self):
+        deadlines = [deadline for deadline in (source.next_deadline() for source in self.timed) if deadline is not None]
+        if not deadlines:
+            return None
+        return max(min(deadlines) - time.monotonic(), 0)
+
+
+    def run(self):
+        while True:
+            self.apply_changes()
+            for key, mask in self.selector.select(self.get_timeout()):
+                if key.data is None:
+                    try:
+                        self.wake_reader.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    keep = key.data()
+                except Exception:
+                    traceback.print_exc()
+                    keep = False
+                if keep is False:
+                    self.unregister(key.fileobj)
+            now = time.monotonic()
+            for source in list(self.timed):
+                deadline = source.next_deadline()
+                if deadline is not None and deadline <= now:
+                    source.sweep()
+
+
+io_loop = None
+io_loop_lock = threading.Lock()
+
+
+def get_io_loop():
+    '''
+    :return: the IoLoop shared by all connections of this process
+    '''
+    global io_loop
+    with io_loop_lock:
+        if io_loop is None:
+            io_loop = IoLoop()
+        return io_loop
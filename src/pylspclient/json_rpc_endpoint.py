@@ -1,11 +1,19 @@
 from __future__ import print_function
 import json
+import contextlib
 from .lsp_structs import *
+from .lsp_recorder import SENT, RECEIVED
 import threading
 
-JSON_RPC_REQ_FORMAT = "Content-Length: {json_string_len}\r\n\r\n{json_string}"
+JSON_RPC_HEADER_FORMAT = b"Content-Length: %d\r\n\r\n"
 LEN_HEADER = "Content-Length: "
 TYPE_HEADER = "Content-Type: "
+HEADER_END = b"\r\n\r\n"
+HEADER_SEPARATOR = b"\r\n"
+LEN_HEADER_BYTES = LEN_HEADER.encode()
+TYPE_HEADER_BYTES = TYPE_HEADER.encode()
+READ_CHUNK_SIZE = 64 * 1024
+SMALL_MESSAGE_SIZE = 64 * 1024
 
 
 # TODO: add content-type
@@ -15,8 +23,118 @@ class MyEncoder(json.JSONEncoder):
     """
     Encodes an object in JSON
     """
-    def default(self, o): # pylint: disable=E0202
-        return o.__dict__ 
+    # called by the C encoder for each struct it meets, nested structs are converted by to_json itself
+    default = staticmethod(to_json)
+
+
+ENCODER = MyEncoder()
+
+
+def encode_message(message):
+    '''
+    Encodes a JSON RPC message to bytes.
+
+    :param dict message: The message.
+    :return: the encoded message
+    '''
+    # the output is pure ASCII, so encoding it is a plain copy and its length is the byte length
+    return ENCODER.encode(message).encode()
+
+
+class MessageBuffer(object):
+    '''
+    Incremental parser for "Content-Length" framed JSON RPC messages. Bytes are appended to a single bytearray and
+    complete bodies are handed to the JSON decoder as bytes, without decoding them to str first.
+    '''
+    def __init__(self):
+        self.buffer = bytearray()
+        self.scan_pos = 0
+        self.header_end = -1
+        self.message_size = None
+        # after a bad header, where its body ends is unknown
+        self.resync = False
+
+
+    def feed(self, data):
+        '''
+        Appends received bytes.
+
+        :param bytes|memoryview data: The bytes to append.
+        '''
+        self.buffer += data
+
+
+    def parse_header(self, header):
+        message_size = None
+        for line in header.split(HEADER_SEPARATOR):
+            if line.startswith(LEN_HEADER_BYTES):
+                line = line[len(LEN_HEADER_BYTES):]
+                if not line.isdigit():
+                    raise ResponseError(ErrorCodes.ParseError, "Bad header: size is not int")
+                message_size = int(line)
+            elif line.startswith(TYPE_HEADER_BYTES):
+                # nothing todo with type for now.
+                pass
+            else:
+                raise ResponseError(ErrorCodes.ParseError, "Bad header: unkown header")
+        if not message_size:
+            raise ResponseError(ErrorCodes.ParseError, "Bad header: missing size")
+        return message_size
+
+
+    def next_message(self):
+        '''
+        Pops the next complete message from the buffer.
+
+        :return: the decoded message, or None if more bytes are needed.
+        '''
+        body = self.next_body()
+        if body is None:
+            return None
+        return json.loads(body)
+
+
+    def next_body(self):
+        '''
+        Pops the body of the next complete message from the buffer, without decoding it.
+
+        :return: the body as bytes, or None if more bytes are needed.
+        '''
+        buffer = self.buffer
+        if self.resync:
+            # skip to the next frame
+            start = buffer.find(LEN_HEADER_BYTES)
+            if start < 0:
+                del buffer[:max(len(buffer) - len(LEN_HEADER_BYTES) + 1, 0)]
+                return None
+            del buffer[:start]
+            self.resync = False
+        if self.header_end < 0:
+            header_end = buffer.find(HEADER_END, self.scan_pos)
+            if header_end < 0:
+                # the terminator may be split between two reads
+                self.scan_pos = max(len(buffer) - len(HEADER_END) + 1, 0)
+                return None
+            self.scan_pos = 0
+            try:
+                self.message_size = self.parse_header(bytes(buffer[:header_end]))
+            except ResponseError:
+                del buffer[:header_end + len(HEADER_END)]
+                self.resync = True
+                raise
+            self.header_end = header_end + len(HEADER_END)
+
+        message_end = self.header_end + self.message_size
+        if len(buffer) < message_end:
+            return None
+
+        with memoryview(buffer) as view:
+            body = view[self.header_end:message_end].tobytes()
+        # deleting from the front of a bytearray only moves its start, the memory is reused
+        del buffer[:message_end]
+        self.header_end = -1
+        self.message_size = None
+        return body
 
 
 class JsonRpcEndpoint(object):
@@ -24,21 +142,27 @@ class JsonRpcEndpoint(object):
     Thread safe JSON RPC endpoint implementation. Responsible to recieve and send JSON RPC messages, as described in the
     protocol. More information can be found: https://www.jsonrpc.org/
     '''
-    def __init__(self, stdin, stdout):
+    def __init__(self, stdin, stdout, recorder=None):
         self.stdin = stdin
         self.stdout = stdout
+        # an LspRecorder that logs every frame, for replaying the session later
+        self.recorder = recorder
         self.read_lock = threading.Lock() 
-        self.write_lock = threading.Lock() 
+        self.message_buffer = MessageBuffer()
+        self.read_chunk = bytearray(READ_CHUNK_SIZE)
+        self.write_lock = threading.RLock() 
+        self.batch_depth = 0
 
     @staticmethod
-    def __add_header(json_string):
+    def __encode(message):
         '''
-        Adds a header for the given json string
-        
-        :param str json_string: The string
-        :return: the string with the header
+        Encodes the given message to the bytes sent on the wire.
+
+        :param dict message: The message.
+        :return: the header and the body, as separate bytes objects
         '''
-        return JSON_RPC_REQ_FORMAT.format(json_string_len=len(json_string), json_string=json_string)
+        body = encode_message(message)
+        return JSON_RPC_HEADER_FORMAT % len(body), body
 
 
     def send_request(self, message):
@@ -47,11 +171,65 @@ class JsonRpcEndpoint(object):
 
         :param dict message: The message to send.            
         '''
-        json_string = json.dumps(message, cls=MyEncoder)
-        jsonrpc_req = self.__add_header(json_string)
+        header, body = self.__encode(message)
         with self.write_lock:
-            self.stdin.write(jsonrpc_req.encode())
-            self.stdin.flush()
+            if self.recorder is not None:
+                self.recorder.record(SENT, body)
+            if len(body) < SMALL_MESSAGE_SIZE:
+                self.stdin.write(header + body)
+            else:
+                # don't copy large bodies just to prepend the header
+                self.stdin.write(header)
+                self.stdin.write(body)
+            if self.batch_depth == 0:
+                self.stdin.flush()
+
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Holds back flushing while inside the block, so messages sent in it go out with a single flush.
+        Other threads can't write until the block is left.
+        '''
+        with self.write_lock:
+            self.batch_depth += 1
+            try:
+                yield
+            finally:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.stdin.flush()
+
+
+    def read_into_buffer(self):
+        '''
+        Reads whatever the stream has available into the message buffer. Doesn't block once a selector reported
+        the stream readable.
+
+        :return: False when the stream is closed.
+        '''
+        readinto = getattr(self.stdout, "readinto1", None) or self.stdout.readinto
+        size = readinto(self.read_chunk)
+        if not size:
+            return False
+        with memoryview(self.read_chunk) as chunk:
+            self.message_buffer.feed(chunk[:size])
+        return True
+
+
+    def next_message(self):
+        '''
+        Pops the next complete message already read, without touching the stream.
+
+        :return: a message, or None if more bytes are needed.
+        '''
+        if self.recorder is None:
+            return self.message_buffer.next_message()
+        body = self.message_buffer.next_body()
+        if body is None:
+            return None
+        self.recorder.record(RECEIVED, body)
+        return json.loads(body)
 
 
     def recv_response(self):
@@ -61,33 +239,10 @@ class JsonRpcEndpoint(object):
         :return: a message
         '''
         with self.read_lock:
-            message_size = None
             while True:
-                #read header
-                line = self.stdout.readline()
-                if not line:
+                message = self.next_message()
+                if message is not None:
+                    return message
+                if not self.read_into_buffer():
                     # server quit
                     return None
-                line = line.decode("utf-8")
-                if not line.endswith("\r\n"):
-                    raise ResponseError(ErrorCodes.ParseError, "Bad header: missing newline")
-                #remove the "\r\n"
-                line = line[:-2]
-                if line == "":
-                    # done with the headers
-                    break
-                elif line.startswith(LEN_HEADER):
-                    line = line[len(LEN_HEADER):]
-                    if not line.isdigit():
-                        raise ResponseError(ErrorCodes.ParseError, "Bad header: size is not int")
-                    message_size = int(line)
-                elif line.startswith(TYPE_HEADER):
-                    # nothing todo with type for now.
-                    pass
-                else:
-                    raise ResponseError(ErrorCodes.ParseError, "Bad header: unkown header")
-            if not message_size:
-                raise ResponseError(ErrorCodes.ParseError, "Bad header: missing size")
-
-            jsonrpc_res = self.stdout.read(message_size).decode("utf-8")
-            return json.loads(jsonrpc_res)
@@ -1,65 +1,365 @@
 from __future__ import print_function
 import threading
+import time
+from concurrent import futures
+from concurrent.futures import Future
 from .lsp_structs import *
 
+# how long an expired or cancelled request is remembered, so its reply can still be recognised
+LATE_RESPONSE_WINDOW = 60
+# how much longer than the request timeout call_method waits, in case nobody sweeps the request
+RESULT_SLACK = 1
+
+class PendingRequest(object):
+    '''
+    Handle for a request sent through LspEndpoint.call_method that can be cancelled from another thread.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoint = None
+        self.id = None
+        self.cancelled = False
+
+
+    def attach(self, endpoint, rpc_id):
+        '''
+        Binds the handle to a sent request.
+
+        :return: False if the request was cancelled before it was sent.
+        '''
+        with self.lock:
+            if self.cancelled:
+                return False
+            self.endpoint = endpoint
+            self.id = rpc_id
+            return True
+
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            endpoint = self.endpoint
+        if endpoint is not None:
+            endpoint.cancel_request(self.id)
+
+
+class PendingRequestTable(object):
+    '''
+    Thread safe table of the requests waiting for a response. Allocates request ids, expires requests past their
+    deadline and keeps count of the responses nobody waits for anymore.
+    '''
+    def __init__(self, wakeup=None):
+        self.cond = threading.Condition()
+        self.wakeup = wakeup
+        self.next_id = 0
+        self.entries = {}
+        self.finished = {}
+        self.closed = False
+        self.timeouts = 0
+        self.cancelled = 0
+        self.late_responses = 0
+        self.orphaned_responses = 0
+
+
+    def add(self, future, timeout):
+        '''
+        Registers a new request.
+
+        :param Future future: Resolved with the response.
+        :param float timeout: Seconds after which the request expires.
+        :return: the id allocated for the request
+        '''
+        with self.cond:
+            rpc_id = self.next_id
+            self.next_id += 1
+            closed = self.closed
+            if not closed:
+                was_empty = not self.entries
+                self.entries[rpc_id] = (future, time.monotonic() + timeout)
+                self.cond.notify()
+        if closed:
+            # the server is gone and nobody would ever sweep the request
+            future.set_exception(EOFError("server quit"))
+        elif was_empty and self.wakeup:
+            # whoever sweeps may be sleeping without a deadline
+            self.wakeup()
+        return rpc_id
+
+
+    def pop(self, rpc_id):
+        with self.cond:
+            entry = self.entries.pop(rpc_id, None)
+        return entry[0] if entry else None
+
+
+    def resolve(self, rpc_id):
+        '''
+        Takes the request a response belongs to.
+
+        :return: the request's future, or None if nobody waits for this response.
+        '''
+        with self.cond:
+            entry = self.entries.pop(rpc_id, None)
+            if entry:
+                return entry[0]
+            reason, finished_at = self.finished.pop(rpc_id, (None, None))
+            if reason == "expired":
+                self.late_responses += 1
+            elif reason is None:
+                self.orphaned_responses += 1
+            return None
+
+
+    def cancel(self, rpc_id):
+        with self.cond:
+            entry = self.entries.pop(rpc_id, None)
+            if entry is None:
+                return None
+            self.cancelled += 1
+            self.finished[rpc_id] = ("cancelled", time.monotonic())
+            return entry[0]
+
+
+    def sweep(self):
+        '''
+        Removes the requests past their deadline.
+
+        :return: the futures of the expired requests
+        '''
+        now = time.monotonic()
+        expired = []
+        with self.cond:
+            for rpc_id, (future, deadline) in list(self.entries.items()):
+                if deadline <= now:
+                    del self.entries[rpc_id]
+                    self.finished[rpc_id] = ("expired", now)
+                    self.timeouts += 1
+                    expired.append(future)
+            # the oldest finished requests come first
+            while self.finished:
+                rpc_id = next(iter(self.finished))
+                if self.finished[rpc_id][1] > now - LATE_RESPONSE_WINDOW:
+                    break
+                del self.finished[rpc_id]
+        return expired
+
+
+    def next_deadline(self):
+        '''
+        :return: when the next request or finished marker expires, or None if there is nothing to expire.
+        '''
+        with self.cond:
+            if self.entries:
+                return min(deadline for future, deadline in self.entries.values())
+            if self.finished:
+                return next(iter(self.finished.values()))[1] + LATE_RESPONSE_WINDOW
+            return None
+
+
+    def wait_for_deadline(self):
+        '''
+        Blocks until the earliest deadline passes, or until a request is added or the table closed.
+        '''
+        with self.cond:
+            if self.closed:
+                return
+            if not self.entries:
+                self.cond.wait(LATE_RESPONSE_WINDOW)
+                return
+            earliest = min(deadline for future, deadline in self.entries.values())
+            self.cond.wait(max(earliest - time.monotonic(), 0))
+
+
+    def pop_all(self):
+        with self.cond:
+            futures = [future for future, deadline in self.entries.values()]
+            self.entries.clear()
+            return futures
+
+
+    def wake(self):
+        '''
+        Wakes whoever waits in wait_for_deadline.
+        '''
+        with self.cond:
+            self.cond.notify()
+
+
+    def close(self):
+        '''
+        Marks the server as gone, requests added afterwards fail right away.
+        '''
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+
+    def get_stats(self):
+        with self.cond:
+            return {
+                "pending": len(self.entries),
+                "timeouts": self.timeouts,
+                "cancelled": self.cancelled,
+                "late_responses": self.late_responses,
+                "orphaned_responses": self.orphaned_responses,
+            }
+
+
 class LspEndpoint(threading.Thread):
-    def __init__(self, json_rpc_endpoint, method_callbacks={}, notify_callbacks={}, timeout=2):
+    def __init__(self, json_rpc_endpoint, method_callbacks={}, notify_callbacks={}, timeout=2, exit_callback=None, io_loop=None):
         threading.Thread.__init__(self)
+        self.daemon = True
+        self.exit_callback = exit_callback
         self.json_rpc_endpoint = json_rpc_endpoint
         self.notify_callbacks = notify_callbacks
         self.method_callbacks = method_callbacks
-        self.event_dict = {}
-        self.response_dict = {}
-        self.next_id = 0
+        # without a usable loop the endpoint falls back to its own reader and sweeper threads
+        if io_loop is not None and not io_loop.supports(json_rpc_endpoint.stdout):
+            io_loop = None
+        self.io_loop = io_loop
+        self.pending = PendingRequestTable(io_loop.wake if io_loop else None)
         self._timeout = timeout
         self.shutdown_flag = False
+        self.exited = False
 
 
     def handle_result(self, rpc_id, result, error):
         print("hanlde result ", rpc_id, result, error)
-        self.response_dict[rpc_id] = (result, error)
-        if rpc_id in self.event_dict:
-            cond = self.event_dict[rpc_id]
-            cond.acquire()
-            cond.notify()
-            cond.release()
+        future = self.pending.resolve(rpc_id)
+        if future is None:
+            # timed out, cancelled or unknown, nobody waits for it
+            return
+        if error:
+            future.set_exception(ResponseError(error.get("code"), error.get("message"), error.get("data")))
+        else:
+            future.set_result(result)
+
+
+    def sweep(self):
+        for future in self.pending.sweep():
+            future.set_exception(TimeoutError())
+
+
+    def next_deadline(self):
+        return self.pending.next_deadline()
+
+
+    def sweep_loop(self):
+        while not self.shutdown_flag and not self.pending.closed:
+            self.pending.wait_for_deadline()
+            self.sweep()
+
+
+    def start(self):
+        if self.io_loop:
+            self.io_loop.add_timed(self)
+            self.io_loop.add_reader(self.json_rpc_endpoint.stdout, self.on_readable)
+            return
+        threading.Thread.start(self)
+        threading.Thread(target=self.sweep_loop, daemon=True).start()
 
 
     def stop(self):
         self.shutdown_flag = True
+        # the server may still be alive, a shutdown request can still go out
+        self.pending.wake()
+        if self.io_loop:
+            self.io_loop.remove_reader(self.json_rpc_endpoint.stdout)
+            self.io_loop.remove_timed(self)
+
+
+    def get_stats(self):
+        return self.pending.get_stats()
 
 
     def run(self):
-        while not self.shutdown_flag:
-            try:
-                jsonrpc_message = self.json_rpc_endpoint.recv_response()
+        try:
+            while not self.shutdown_flag:
+                try:
+                    jsonrpc_message = self.json_rpc_endpoint.recv_response()
+                except (ResponseError, ValueError) as err:
+                    # the broken message is dropped, the ones after it are still good
+                    print("bad message from server", err)
+                    continue
                 if jsonrpc_message is None:
                     print("server quit")
                     break
-                method = jsonrpc_message.get("method")
-                result = jsonrpc_message.get("result")
-                error = jsonrpc_message.get("error")
-                rpc_id = jsonrpc_message.get("id")
-                params = jsonrpc_message.get("params")
-
-                if method:
-                    if rpc_id:
-                        # a call for method
-                        if method not in self.method_callbacks:
-                            raise ResponseError(ErrorCodes.MethodNotFound, "Method not found: {method}".format(method=method))
-                        result = self.method_callbacks[method](params)
-                        self.send_response(rpc_id, result, None)
-                    else:
-                        # a call for notify
-                        if method not in self.notify_callbacks:
-                            # Have nothing to do with this.
-                            print("Notify method not found: {method}.".format(method=method))
-                        else:
-                            self.notify_callbacks[method](params)
+                self.handle_message(jsonrpc_message)
+        finally:
+            self.handle_exit()
+
+
+    def on_readable(self):
+        '''
+        Called by the io loop when the server sent something.
+
+        :return: False once the server is gone.
+        '''
+        if self.shutdown_flag:
+            return False
+        if not self.json_rpc_endpoint.read_into_buffer():
+            print("server quit")
+            self.handle_exit()
+            return False
+        while not self.shutdown_flag:
+            try:
+                jsonrpc_message = self.json_rpc_endpoint.next_message()
+            except (ResponseError, ValueError) as err:
+                # the broken message is dropped, the ones after it are still good
+                print("bad message from server", err)
+                continue
+            if jsonrpc_message is None:
+                break
+            self.handle_message(jsonrpc_message)
+        return True
+
+
+    def handle_message(self, jsonrpc_message):
+        method = jsonrpc_message.get("method")
+        result = jsonrpc_message.get("result")
+        error = jsonrpc_message.get("error")
+        rpc_id = jsonrpc_message.get("id")
+        params = jsonrpc_message.get("params")
+
+        try:
+            if method:
+                if rpc_id:
+                    # a call for method
+                    if method not in self.method_callbacks:
+                        raise ResponseError(ErrorCodes.MethodNotFound, "Method not found: {method}".format(method=method))
+                    result = self.method_callbacks[method](params)
+                    self.send_response(rpc_id, result, None)
                 else:
-                    self.handle_result(rpc_id, result, error)
-            except ResponseError as e:
-                self.send_response(rpc_id, None, e)
+                    # a call for notify
+                    if method not in self.notify_callbacks:
+                        # Have nothing to do with this.
+                        print("Notify method not found: {method}.".format(method=method))
+                    else:
+                        self.notify_callbacks[method](params)
+            else:
+                self.handle_result(rpc_id, result, error)
+        except ResponseError as e:
+            self.send_response(rpc_id, None, e)
+
+
+    def handle_exit(self):
+        if self.exited:
+            return
+        self.exited = True
+        if self.io_loop:
+            self.io_loop.remove_timed(self)
+        self.fail_pending(EOFError("server quit"))
+        if not self.shutdown_flag and self.exit_callback:
+            self.exit_callback()
+
+
+    def fail_pending(self, err):
+        '''
+        Fails all requests still waiting for a response, used when the server went away.
+        '''
+        self.pending.close()
+        for future in self.pending.pop_all():
+            future.set_exception(err)
 
 
     def send_response(self, id, result, error):
@@ -83,33 +383,63 @@ class LspEndpoint(threading.Thread):
         self.json_rpc_endpoint.send_request(message_dict)
 
 
-    def call_method(self, method_name, **kwargs):
-        current_id = self.next_id
-        self.next_id += 1
-        cond = threading.Condition()
-        self.event_dict[current_id] = cond
-        print("lsp_endpoint even_dic", self.event_dict)
-        cond.acquire()
-        self.send_message(method_name, kwargs, current_id)
-        if self.shutdown_flag:
-            cond.release()
-            return None
+    def call_method_async(self, method_name, pending_request=None, **kwargs):
+        '''
+        Sends a request without waiting for its response.
 
-        if not cond.wait(timeout=self._timeout):
-            cond.release()
-            if current_id in self.event_dict:
-                self.event_dict.pop(current_id)
-            if current_id in self.response_dict:
-                result, error = self.response_dict.pop(current_id)
+        :param PendingRequest pending_request: Optional handle to cancel the request with.
+        :return: a Future resolved with the result, or failed with ResponseError or TimeoutError.
+        '''
+        future = Future()
+        current_id = self.pending.add(future, self._timeout)
+        if future.done():
+            # the server quit
+            return future
+        if pending_request is not None and not pending_request.attach(self, current_id):
+            if self.pending.pop(current_id) is not None:
+                future.set_exception(ResponseError(ErrorCodes.RequestCancelled, "Request cancelled"))
+            return future
+
+        try:
+            self.send_message(method_name, kwargs, current_id)
+        except Exception as err:
+            if self.pending.pop(current_id) is not None:
+                future.set_exception(err)
+            return future
+
+        if self.shutdown_flag and self.pending.pop(current_id) is not None:
+            future.set_result(None)
+        return future
+
+
+    def call_method(self, method_name, pending_request=None, **kwargs):
+        future = self.call_method_async(method_name, pending_request, **kwargs)
+        try:
+            return future.result(self._timeout + RESULT_SLACK)
+        except futures.TimeoutError:
             raise TimeoutError()
-        cond.release()
 
-        self.event_dict.pop(current_id)
-        result, error = self.response_dict.pop(current_id)
-        if error:
-            raise ResponseError(error.get("code"), error.get("message"), error.get("data"))
-        return result
+
+    def cancel_request(self, rpc_id):
+        '''
+        Sends $/cancelRequest for a pending request and fails its future right away.
+
+        :param int rpc_id: The id of the request to cancel.
+        '''
+        future = self.pending.cancel(rpc_id)
+        if future is None:
+            # already answered or timed out
+            return
+        future.set_exception(ResponseError(ErrorCodes.RequestCancelled, "Request cancelled"))
+        self.send_notification("$/cancelRequest", id=rpc_id)
 
 
     def send_notification(self, method_name, **kwargs):
         self.send_message(method_name, kwargs)
+
+
+    def batch(self):
+        '''
+        Context manager that sends all notifications issued inside it with one flush.
+        '''
+        return self.json_rpc_endpoint.batch()
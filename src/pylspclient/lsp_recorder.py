@@ -0,0 +1,117 @@
+from __future__ import print_function
+import os
+import json
+import time
+import struct
+import threading
+from collections import namedtuple
+
+MAGIC = b"LSPREC1\n"
+# direction, microseconds since the session began, body length
+RECORD_HEADER = struct.Struct("<cQI")
+SESSION = b"B"
+SENT = b"S"
+RECEIVED = b"R"
+# bodies are buffered, a timer flushes them at most this many seconds after they were written
+FLUSH_INTERVAL = 1.0
+
+RecordedFrame = namedtuple("RecordedFrame", ["session", "direction", "time", "body"])
+
+
+class LspRecorder(object):
+    '''
+    Appends the body of every frame a JsonRpcEndpoint sends or receives to a log file, with the time since the
+    endpoint was created. Each endpoint starts a new session in the log, so one file can collect many of them.
+    '''
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_flush = self.started
+        self.flush_timer = None
+        self.file = open(os.path.expanduser(path), "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.write(SESSION, json.dumps({"started": time.time(), "pid": os.getpid()}).encode())
+
+
+    def record(self, direction, body):
+        '''
+        Records one frame. Never raises, a recording that failed just stops.
+
+        :param bytes direction: SENT or RECEIVED.
+        :param bytes body: The frame body, without its header.
+        '''
+        try:
+            self.write(direction, body)
+        except (OSError, ValueError) as err:
+            print("lsp recorder stopped:", err)
+            self.close()
+
+
+    def write(self, direction, body):
+        now = time.monotonic()
+        with self.lock:
+            if self.file is None:
+                # closed, the connection is going away
+                return
+            self.file.write(RECORD_HEADER.pack(direction, int((now - self.started) * 1000000), len(body)))
+            self.file.write(body)
+            if now - self.last_flush > FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = now
+            elif self.flush_timer is None:
+                # nothing else may be written for a long while
+                self.flush_timer = threading.Timer(FLUSH_INTERVAL, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+
+    def flush(self):
+        try:
+            with self.lock:
+                self.flush_timer = None
+                if self.file is None:
+                    return
+                self.file.flush()
+                self.last_flush = time.monotonic()
+        except (OSError, ValueError) as err:
+            print("lsp recorder stopped:", err)
+            self.close()
+
+
+    def close(self):
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            if self.file is None:
+                return
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+
+
+def read_recording(path):
+    '''
+    Reads a log written by LspRecorder. A record cut short by a crash ends the log.
+
+    :param str path: The log file.
+    :return: a generator of RecordedFrame, times are in seconds since the start of their session.
+    '''
+    session = -1
+    with open(os.path.expanduser(path), "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not an lsp recording: %s" % path)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            direction, micros, size = RECORD_HEADER.unpack(header)
+            body = f.read(size)
+            if len(body) < size:
+                return
+            if direction == SESSION:
+                session += 1
+            yield RecordedFrame(session, direction, micros / 1000000, body)
@@ -14,6 +14,24 @@ def to_type(o, new_type):
         return new_type(**o)
 
 
+def to_json(o):
+    '''
+    Helper function that converts a struct to the dict sent on the wire, skipping fields that are not set.
+    Structs with a to_json method use it, anything else is serialized from its __dict__.
+
+    :param object o: The object to convert
+    '''
+    encode = getattr(o, "to_json", None)
+    if encode is not None:
+        return encode()
+    if hasattr(o, "__dict__"):
+        return {key: value for key, value in o.__dict__.items() if value is not None}
+    if o is None or isinstance(o, (dict, list, tuple, str, int, float)):
+        # a field given as plain JSON already
+        return o
+    raise TypeError("%r is not JSON serializable" % (o,))
+
+
 class Position(object):
     def __init__(self, line, character):
         """
@@ -26,6 +44,10 @@ class Position(object):
         self.character = character
 
 
+    def to_json(self):
+        return {"line": self.line, "character": self.character}
+
+
 class Range(object):
     def __init__(self, start, end):
         """
@@ -38,6 +60,10 @@ class Range(object):
         self.end = to_type(end, Position)
 
 
+    def to_json(self):
+        return {"start": self.start.to_json(), "end": self.end.to_json()}
+
+
 class Location(object):
     """
     Represents a location inside a resource, such as a line inside a text file.
@@ -53,6 +79,10 @@ class Location(object):
         self.range = to_type(range, Range)
 
 
+    def to_json(self):
+        return {"uri": self.uri, "range": self.range.to_json()}
+
+
 class LocationLink(object):
     """
     Represents a link between a source and a target location.
@@ -148,6 +178,10 @@ class TextDocumentItem(object):
         self.text = text
 
 
+    def to_json(self):
+        return {"uri": self.uri, "languageId": self.languageId, "version": self.version, "text": self.text}
+
+
 class TextDocumentIdentifier(object):
     """
     Text documents are identified using a URI. On the protocol level, URIs are passed as strings. 
@@ -161,6 +195,10 @@ class TextDocumentIdentifier(object):
         self.uri = uri
 
 
+    def to_json(self):
+        return {"uri": self.uri}
+
+
 class VersionedTextDocumentIdentifier(TextDocumentIdentifier):
     """
     An identifier to denote a specific version of a text document.
@@ -183,6 +221,10 @@ class VersionedTextDocumentIdentifier(TextDocumentIdentifier):
         self.version = version
 
 
+    def to_json(self):
+        return {"uri": self.uri, "version": self.version}
+
+
 class TextDocumentContentChangeEvent(object):
     """
     An event describing a change to a text document. If range and rangeLength are omitted
@@ -201,6 +243,22 @@ class TextDocumentContentChangeEvent(object):
         self.text = text
 
 
+    def to_json(self):
+        if self.range is None:
+            # the whole document
+            return {"text": self.text}
+        result = {"range": to_json(self.range), "text": self.text}
+        if self.rangeLength is not None:
+            result["rangeLength"] = self.rangeLength
+        return result
+
+
+class TextDocumentSyncKind(object):
+    NONE = 0
+    FULL = 1
+    INCREMENTAL = 2
+
+
 class TextDocumentPositionParams(object):
     """
     A parameter literal used in requests to pass a text document and a position inside that document.
@@ -216,6 +274,10 @@ class TextDocumentPositionParams(object):
         self.position = position
 
 
+    def to_json(self):
+        return {"textDocument": to_json(self.textDocument), "position": to_json(self.position)}
+
+
 class LANGUAGE_IDENTIFIER(object):
     BAT="bat"
     BIBTEX="bibtex"
@@ -406,6 +468,13 @@ class CompletionContext(object):
             self.triggerCharacter = triggerCharacter
 
 
+    def to_json(self):
+        result = {"triggerKind": self.triggerKind}
+        if hasattr(self, "triggerCharacter"):
+            result["triggerCharacter"] = self.triggerCharacter
+        return result
+
+
 class TextEdit(object):
     """
     A textual edit applicable to a text document.
@@ -420,6 +489,10 @@ class TextEdit(object):
         self.newText = newText
 
 
+    def to_json(self):
+        return {"range": to_json(self.range), "newText": self.newText}
+
+
 class InsertTextFormat(object):
     PlainText = 1
     Snippet = 2
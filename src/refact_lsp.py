@@ -1,18 +1,71 @@
 import os
 import socket
 import pathlib
+import time
+import threading
+import contextlib
+from concurrent.futures import Future
 from typing import Optional, Dict, Tuple
 from .pylspclient.lsp_structs import *
-from .pylspclient.lsp_endpoint import LspEndpoint
+from .pylspclient.lsp_endpoint import LspEndpoint, PendingRequest
 from .pylspclient.lsp_client import LspClient
 from .pylspclient.json_rpc_endpoint import JsonRpcEndpoint
+from .pylspclient.io_loop import get_io_loop
+from .pylspclient.lsp_recorder import LspRecorder
+from .perf_stats import perf_stats
+from .settings import get_setting
 
 class LSP:
-	def __init__(self, process, statusbar):
+	def __init__(self, statusbar, shared = False):
 		self.statusbar = statusbar
-		self.connect(process)
+		# a shared server keeps running for its other clients when we disconnect
+		self.shared = shared
+		self.sync_kind = TextDocumentSyncKind.FULL
+		self.lsp_endpoint = None
+		self.lsp_client = None
+		self.recorder = None
+		# calls made while the server is starting, sent in order once it's up
+		self.ready = False
+		self.queue = []
+		self.queue_lock = threading.RLock()
+
+	def defer(self, call, file_name = None, replace = False):
+		# queues call until the server is ready, returns False if it can be made right away.
+		# With replace, call supersedes the queued call for file_name if that was
+		# queued with replace too, so a slow start doesn't pile up full copies of
+		# a document being typed into
+		with self.queue_lock:
+			if self.ready:
+				return False
+			if replace:
+				for i in range(len(self.queue) - 1, -1, -1):
+					queued_file_name, queued_replace, queued_call = self.queue[i]
+					if queued_file_name == file_name:
+						if queued_replace:
+							del self.queue[i]
+						break
+			self.queue.append((file_name, replace, call))
+			return True
+
+	def set_ready(self):
+		# also called when the server failed to start, the queued calls then fail
+		# right away instead of waiting forever. The queue is flushed under the
+		# lock, so no call from another thread overtakes a queued one.
+		with self.queue_lock:
+			self.ready = True
+			queue = self.queue
+			self.queue = []
+			with self.batch():
+				for file_name, replace, call in queue:
+					call()
+
+	def is_ready(self):
+		return self.ready
 
 	def load_document(self, file_name: str, text: str, version: int = 1, languageId = LANGUAGE_IDENTIFIER.PYTHON):
+		if self.defer(lambda: self.load_document(file_name, text, version, languageId), file_name):
+			return
+
 		print("load_document", file_name)
 
 		if languageId is None:
@@ -28,28 +81,50 @@ class LSP:
 			self.statusbar.handle_err(err)
 			print("lsp didOpen error")
 
-	def did_change(self, file_name: str, version: int, text: str, languageId = LANGUAGE_IDENTIFIER.PYTHON):
-		print("did_change file_name", file_name)
+	def did_change(self, file_name: str, version: int, text: str):
+		if self.defer(lambda: self.did_change(file_name, version, text), file_name, replace = True):
+			return True
 
-		if languageId is None:
-			languageId = LANGUAGE_IDENTIFIER.PYTHON
+		print("did_change file_name", file_name)
 
 		if file_name is None:
-			return
+			return False
 
 		uri = pathlib.Path(file_name).as_uri()
 		
 		try:
-			self.lsp_client.didChange(TextDocumentItem(uri, languageId, version, text=text), [TextDocumentContentChangeEvent(None, None, text)])
+			self.lsp_client.didChange(VersionedTextDocumentIdentifier(uri, version), [TextDocumentContentChangeEvent(None, None, text)])
+			return True
 		except Exception as err:
 			self.statusbar.handle_err(err)
 			print("lsp didChange error")
+			return False
 
-	def did_save(self, file_name: str, version: int, text: str, languageId = LANGUAGE_IDENTIFIER.PYTHON):
-		print("did_save file_name", file_name)
+	def did_change_incremental(self, file_name: str, version: int, changes):
+		if self.defer(lambda: self.did_change_incremental(file_name, version, changes), file_name):
+			return True
 
-		if languageId is None:
-			languageId = LANGUAGE_IDENTIFIER.PYTHON
+		if file_name is None:
+			return False
+
+		uri = pathlib.Path(file_name).as_uri()
+
+		try:
+			self.lsp_client.didChange(VersionedTextDocumentIdentifier(uri, version), [get_change_event(change) for change in changes])
+			return True
+		except Exception as err:
+			self.statusbar.handle_err(err)
+			print("lsp didChange error")
+			return False
+
+	def supports_incremental_sync(self):
+		return self.sync_kind == TextDocumentSyncKind.INCREMENTAL
+
+	def did_save(self, file_name: str):
+		if self.defer(lambda: self.did_save(file_name), file_name):
+			return
+
+		print("did_save file_name", file_name)
 
 		if file_name is None:
 			return
@@ -57,18 +132,18 @@ class LSP:
 		uri = pathlib.Path(file_name).as_uri()
 
 		try:
-			self.lsp_client.lsp_endpoint.send_notification("textDocument/didSave", textDocument=TextDocumentItem(uri, languageId, version, text=text)) 
+			self.lsp_client.lsp_endpoint.send_notification("textDocument/didSave", textDocument=TextDocumentIdentifier(uri)) 
 
 		except Exception as err:
 			self.statusbar.handle_err(err)
 
 			print("lsp didChange error", str(err))
 
-	def did_close(self, file_name: str, version: int, text: str, languageId = LANGUAGE_IDENTIFIER.PYTHON):
-		print("did_close file_name", file_name)
+	def did_close(self, file_name: str):
+		if self.defer(lambda: self.did_close(file_name), file_name):
+			return
 
-		if languageId is None:
-			languageId = LANGUAGE_IDENTIFIER.PYTHON
+		print("did_close file_name", file_name)
 
 		if file_name is None:
 			return
@@ -76,147 +151,234 @@ class LSP:
 		uri = pathlib.Path(file_name).as_uri()
 
 		try:
-			self.lsp_client.lsp_endpoint.send_notification("textDocument/didClose", textDocument=TextDocumentItem(uri, languageId, version, text=text)) 
+			self.lsp_client.lsp_endpoint.send_notification("textDocument/didClose", textDocument=TextDocumentIdentifier(uri)) 
 		except Exception as err:
 			print("lsp did_close error")
 			self.statusbar.handle_err(err)
 
-	def get_completions(self, file_name, pos: Tuple[int, int], multiline: bool = False):
-		self.statusbar.update_statusbar("loading")
+	def get_completions(self, file_name, pos: Tuple[int, int], multiline: bool = False, pending_request: Optional[PendingRequest] = None):
+		return self.get_completions_async(file_name, pos, multiline, pending_request).result()
+
+	def get_completions_async(self, file_name, pos: Tuple[int, int], multiline: bool = False, pending_request: Optional[PendingRequest] = None) -> Future:
+		# resolves to the server's response, or None when the request failed
+		future = Future()
+		if not self.defer(lambda: self.request_completions(future, file_name, pos, multiline, pending_request), file_name):
+			self.request_completions(future, file_name, pos, multiline, pending_request)
+		return future
+
+	def request_completions(self, future, file_name, pos, multiline, pending_request):
 		params = {
 			"max_new_tokens": 20,
 			"temperature": 0.1
 		}
 
 		if file_name is None:
+			future.set_result(None)
 			return
 
 		uri = pathlib.Path(file_name).as_uri()
 
+		self.statusbar.request_started()
+		started = time.monotonic()
 		try:
-			res = self.lsp_endpoint.call_method(
+			request = self.lsp_endpoint.call_method_async(
 				"refact/getCompletions",
+				pending_request=pending_request,
 				textDocument=TextDocumentIdentifier(uri),
 				position=Position(pos[0], pos[1]),
 				parameters=params,
 				multiline=multiline)
-			self.statusbar.update_statusbar("ok")
-			return res
+			sent = time.monotonic()
+			perf_stats.record("send", sent - started)
 		except Exception as err:
+			# the server never came up
+			self.statusbar.request_finished()
 			self.statusbar.handle_err(err)
+			future.set_result(None)
+			return
+		request.add_done_callback(lambda request: future.set_result(self.get_completions_result(request, started, sent)))
 
-	def shutdown(self):
+	def get_completions_result(self, request, started, sent):
 		try:
-			self.lsp_client.shutdown()
+			res = request.result()
+			received = time.monotonic()
+			perf_stats.record("server", received - sent)
+			self.statusbar.request_finished(received - started)
+			self.statusbar.update_statusbar("ok")
+			return res
+		except ResponseError as err:
+			self.statusbar.request_finished()
+			if err.code == ErrorCodes.RequestCancelled:
+				self.statusbar.update_statusbar("ok")
+			else:
+				self.statusbar.handle_err(err)
 		except Exception as err:
+			self.statusbar.request_finished()
 			self.statusbar.handle_err(err)
 
-			print("lsp error shutdown")
+	def batch(self):
+		if not self.ready or self.lsp_endpoint is None:
+			# queued calls are flushed in one batch anyway
+			return contextlib.nullcontext()
+		return self.lsp_endpoint.batch()
+
+	def get_stats(self):
+		if self.lsp_endpoint is None:
+			return None
+		return self.lsp_endpoint.get_stats()
+
+	def shutdown(self):
+		if self.lsp_endpoint is None:
+			return
+
+		if self.shared:
+			self.lsp_endpoint.stop()
+		else:
+			try:
+				self.lsp_client.shutdown()
+			except Exception as err:
+				self.statusbar.handle_err(err)
+
+				print("lsp error shutdown")
+		if self.recorder:
+			self.recorder.close()
 
 	def logMessage(self, args):
 		print("logMessage", args)
 		
-	def connect(self, process):
+	def connect(self, process, exit_callback = None):
+		# blocks until the server answered initialize, then sends what was queued meanwhile
 		capabilities = {}
-		json_rpc_endpoint = JsonRpcEndpoint(process.stdin, process.stdout)
-		self.lsp_endpoint = LspEndpoint(json_rpc_endpoint, notify_callbacks = {"window/logMessage":print})
+		self.recorder = self.create_recorder()
+		json_rpc_endpoint = JsonRpcEndpoint(process.stdin, process.stdout, self.recorder)
+		self.lsp_endpoint = LspEndpoint(json_rpc_endpoint, notify_callbacks = {"window/logMessage":print}, exit_callback = exit_callback, io_loop = get_io_loop())
 		self.lsp_client = LspClient(self.lsp_endpoint)
 		
 		try:
-			self.lsp_client.initialize(process.pid, None, None, None, capabilities, "off", None)
+			result = self.lsp_client.initialize(process.pid, None, None, None, capabilities, "off", None)
+			self.sync_kind = get_sync_kind(result)
+			initialized = True
 		except Exception as err:
 			self.statusbar.handle_err(err)
 			print("lsp initialize error", err)
+			initialized = False
+		if initialized:
+			self.statusbar.update_statusbar("ok")
+		self.set_ready()
+		return initialized
+
+	def create_recorder(self):
+		# "lsp_record_path" logs the traffic for benchmarks/replay_lsp.py
+		path = get_setting("lsp_record_path", "").strip()
+		if not path:
+			return None
+		try:
+			return LspRecorder(path)
+		except OSError as err:
+			print("lsp recorder error", err)
+			return None
+
+def get_sync_kind(initialize_result):
+	# textDocumentSync is either a TextDocumentSyncKind or TextDocumentSyncOptions
+	if not initialize_result:
+		return TextDocumentSyncKind.FULL
+	sync = initialize_result.get("capabilities", {}).get("textDocumentSync")
+	if isinstance(sync, dict):
+		sync = sync.get("change")
+	if sync is None:
+		return TextDocumentSyncKind.FULL
+	return sync
+
+def get_change_event(change):
+	# change is a sublime.TextChange, positions are in the coordinates of the
+	# document before this change was applied, exactly as LSP expects them
+	start = Position(change.a.row, change.a.col_utf16)
+	end = Position(change.b.row, change.b.col_utf16)
+	return TextDocumentContentChangeEvent(Range(start, end), change.len_utf16, change.str)
+
+# keyed by scope component, the base scope of a syntax is matched from its most
+# specific component down, so "source.python.django" still resolves to python
+SCOPE_LANGUAGE_IDS = {
+	"bat": LANGUAGE_IDENTIFIER.BAT,
+	"batchfile": LANGUAGE_IDENTIFIER.BAT,
+	"dosbatch": LANGUAGE_IDENTIFIER.BAT,
+	"bibtex": LANGUAGE_IDENTIFIER.BIBTEX,
+	"clojure": LANGUAGE_IDENTIFIER.CLOJURE,
+	"coffee": LANGUAGE_IDENTIFIER.COFFESCRIPT,
+	"coffeescript": LANGUAGE_IDENTIFIER.COFFESCRIPT,
+	"c": LANGUAGE_IDENTIFIER.C,
+	"c++": LANGUAGE_IDENTIFIER.CPP,
+	"cpp": LANGUAGE_IDENTIFIER.CPP,
+	"cs": LANGUAGE_IDENTIFIER.CSHARP,
+	"csharp": LANGUAGE_IDENTIFIER.CSHARP,
+	"css": LANGUAGE_IDENTIFIER.CSS,
+	"diff": LANGUAGE_IDENTIFIER.DIFF,
+	"dockerfile": LANGUAGE_IDENTIFIER.DOCKERFILE,
+	"fsharp": LANGUAGE_IDENTIFIER.FSHARP,
+	"commit": LANGUAGE_IDENTIFIER.GIT_COMMIT,
+	"rebase": LANGUAGE_IDENTIFIER.GIT_REBASE,
+	"go": LANGUAGE_IDENTIFIER.GO,
+	"groovy": LANGUAGE_IDENTIFIER.GROOVY,
+	"handlebars": LANGUAGE_IDENTIFIER.HANDLEBARS,
+	"html": LANGUAGE_IDENTIFIER.HTML,
+	"ini": LANGUAGE_IDENTIFIER.INI,
+	"java": LANGUAGE_IDENTIFIER.JAVA,
+	"js": LANGUAGE_IDENTIFIER.JAVASCRIPT,
+	"javascript": LANGUAGE_IDENTIFIER.JAVASCRIPT,
+	"jsx": LANGUAGE_IDENTIFIER.JAVASCRIPT,
+	"json": LANGUAGE_IDENTIFIER.JSON,
+	"latex": LANGUAGE_IDENTIFIER.LATEX,
+	"less": LANGUAGE_IDENTIFIER.LESS,
+	"lua": LANGUAGE_IDENTIFIER.LUA,
+	"makefile": LANGUAGE_IDENTIFIER.MAKEFILE,
+	"markdown": LANGUAGE_IDENTIFIER.MARKDOWN,
+	"objc": LANGUAGE_IDENTIFIER.OBJECTIVE_C,
+	"objc++": LANGUAGE_IDENTIFIER.OBJECTIVE_CPP,
+	"perl": LANGUAGE_IDENTIFIER.Perl,
+	"php": LANGUAGE_IDENTIFIER.PHP,
+	"powershell": LANGUAGE_IDENTIFIER.POWERSHELL,
+	"jade": LANGUAGE_IDENTIFIER.PUG,
+	"pug": LANGUAGE_IDENTIFIER.PUG,
+	"python": LANGUAGE_IDENTIFIER.PYTHON,
+	"r": LANGUAGE_IDENTIFIER.R,
+	"razor": LANGUAGE_IDENTIFIER.RAZOR,
+	"ruby": LANGUAGE_IDENTIFIER.RUBY,
+	"rust": LANGUAGE_IDENTIFIER.RUST,
+	"sass": LANGUAGE_IDENTIFIER.SASS,
+	"scss": LANGUAGE_IDENTIFIER.SCSS,
+	"shaderlab": LANGUAGE_IDENTIFIER.ShaderLab,
+	"shell": LANGUAGE_IDENTIFIER.SHELL_SCRIPT,
+	"shellscript": LANGUAGE_IDENTIFIER.SHELL_SCRIPT,
+	"sql": LANGUAGE_IDENTIFIER.SQL,
+	"swift": LANGUAGE_IDENTIFIER.SWIFT,
+	"ts": LANGUAGE_IDENTIFIER.TYPE_SCRIPT,
+	"tsx": LANGUAGE_IDENTIFIER.TYPE_SCRIPT,
+	"typescript": LANGUAGE_IDENTIFIER.TYPE_SCRIPT,
+	"tex": LANGUAGE_IDENTIFIER.TEX,
+	"vb": LANGUAGE_IDENTIFIER.VB,
+	"asp": LANGUAGE_IDENTIFIER.VB,
+	"xml": LANGUAGE_IDENTIFIER.XML,
+	"xsl": LANGUAGE_IDENTIFIER.XSL,
+	"yaml": LANGUAGE_IDENTIFIER.YAML,
+}
+
+# syntax file path -> language id, a syntax's scope never changes
+syntax_language_ids = {}
+
+def get_language_id(scope):
+	# scope is a base scope like "source.python" or "text.html.markdown"
+	if not scope or scope.isspace():
+		return None
+	for component in reversed(scope.strip().split(".")):
+		language_id = SCOPE_LANGUAGE_IDS.get(component)
+		if language_id:
+			return language_id
+	return None
 
-def get_language_id(file_type):
-	if file_type and not file_type.isspace():
-		if file_type == "python":
-			return LANGUAGE_IDENTIFIER.PYTHON
-		elif file_type == "bibtex":
-			return LANGUAGE_IDENTIFIER.BIBTEX
-		elif file_type == "clojure":
-			return LANGUAGE_IDENTIFIER.CLOJURE
-		elif file_type == "coffeescript":
-			return LANGUAGE_IDENTIFIER.COFFESCRIPT
-		elif file_type == "c":
-			return LANGUAGE_IDENTIFIER.C
-		elif file_type == "cpp":
-			return LANGUAGE_IDENTIFIER.CPP
-		elif file_type == "csharp":
-			return LANGUAGE_IDENTIFIER.CSHARP
-		elif file_type == "css":
-			return LANGUAGE_IDENTIFIER.CSS
-		elif file_type == "diff":
-			return LANGUAGE_IDENTIFIER.DIFF
-		elif file_type == "dockerfile":
-			return LANGUAGE_IDENTIFIER.DOCKERFILE
-		elif file_type == "fsharp":
-			return LANGUAGE_IDENTIFIER.FSHARP
-		elif file_type == "go":
-			return LANGUAGE_IDENTIFIER.GO
-		elif file_type == "groovy":
-			return LANGUAGE_IDENTIFIER.GROOVY
-		elif file_type == "handlebars":
-			return LANGUAGE_IDENTIFIER.HANDLEBARS
-		elif file_type == "html":
-			return LANGUAGE_IDENTIFIER.HTML
-		elif file_type == "ini":
-			return LANGUAGE_IDENTIFIER.INI
-		elif file_type == "java":
-			return LANGUAGE_IDENTIFIER.JAVA
-		elif file_type == "javascript":
-			return LANGUAGE_IDENTIFIER.JAVASCRIPT
-		elif file_type == "json":
-			return LANGUAGE_IDENTIFIER.JSON
-		elif file_type == "latex":
-			return LANGUAGE_IDENTIFIER.LATEX
-		elif file_type == "less":
-			return LANGUAGE_IDENTIFIER.LESS
-		elif file_type == "lua":
-			return LANGUAGE_IDENTIFIER.LUA
-		elif file_type == "makefile":
-			return LANGUAGE_IDENTIFIER.MAKEFILE
-		elif file_type == "markdown":
-			return LANGUAGE_IDENTIFIER.MARKDOWN
-		elif file_type == "perl":
-			return LANGUAGE_IDENTIFIER.Perl
-		elif file_type == "php":
-			return LANGUAGE_IDENTIFIER.PHP
-		elif file_type == "powershell":
-			return LANGUAGE_IDENTIFIER.POWERSHELL
-		elif file_type == "jade":
-			return LANGUAGE_IDENTIFIER.PUG
-		elif file_type == "python":
-			return LANGUAGE_IDENTIFIER.PYTHON
-		elif file_type == "r":
-			return LANGUAGE_IDENTIFIER.R
-		elif file_type == "razor":
-			return LANGUAGE_IDENTIFIER.RAZOR
-		elif file_type == "ruby":
-			return LANGUAGE_IDENTIFIER.RUBY
-		elif file_type == "rust":
-			return LANGUAGE_IDENTIFIER.RUST
-		elif file_type == "sass":
-			return LANGUAGE_IDENTIFIER.SASS
-		elif file_type == "scss":
-			return LANGUAGE_IDENTIFIER.SCSS
-		elif file_type == "shaderlab":
-			return LANGUAGE_IDENTIFIER.ShaderLab
-		elif file_type == "shellscript":
-			return LANGUAGE_IDENTIFIER.SHELL_SCRIPT
-		elif file_type == "sql":
-			return LANGUAGE_IDENTIFIER.SQL
-		elif file_type == "swift":
-			return LANGUAGE_IDENTIFIER.SWIFT
-		elif file_type == "typescript":
-			return LANGUAGE_IDENTIFIER.TYPE_SCRIPT
-		elif file_type == "tex":
-			return LANGUAGE_IDENTIFIER.TEX
-		elif file_type == "vb":
-			return LANGUAGE_IDENTIFIER.VB
-		elif file_type == "xml":
-			return LANGUAGE_IDENTIFIER.XML
-		elif file_type == "xsl":
-			return LANGUAGE_IDENTIFIER.XSL
-		elif file_type == "yaml":
-			return LANGUAGE_IDENTIFIER.YAML
+def get_syntax_language_id(syntax):
+	# syntax is the sublime.Syntax of a view, or None
+	if syntax is None:
+		return None
+	if not syntax.path in syntax_language_ids:
+		syntax_language_ids[syntax.path] = get_language_id(syntax.scope)
+	return syntax_language_ids[syntax.path]
@@ -3,24 +3,90 @@ import sublime_plugin
 import subprocess
 import threading
 import os
+import time
+from collections import deque
 from .refact_lsp import LSP
+from .refact_socket import SocketProcess
+from .pylspclient.io_loop import IoLoop, get_io_loop
 from .statusbar import StatusBar
+from .settings import get_setting
+
+class ServerLog:
+	# Keeps the last max_bytes of the server's stderr. Draining the pipe
+	# continuously stops the server from blocking once the OS buffer fills up.
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.chunks = deque()
+		self.size = 0
+		self.lock = threading.Lock()
+
+	def drain(self, stream):
+		while self.read(stream):
+			pass
+
+	def read(self, stream):
+		# a single read, so the io loop can call it whenever stream is readable;
+		# returns False once the stream is closed. It bypasses the stream's
+		# buffer, data left there would be invisible to select()
+		try:
+			chunk = os.read(stream.fileno(), 65536)
+		except (OSError, ValueError):
+			return False
+		if not chunk:
+			return False
+		self.append(chunk)
+		return True
+
+	def append(self, chunk):
+		with self.lock:
+			self.chunks.append(chunk)
+			self.size = self.size + len(chunk)
+			while self.size > self.max_bytes and len(self.chunks) > 1:
+				self.size = self.size - len(self.chunks.popleft())
+
+	def get_text(self):
+		with self.lock:
+			data = b"".join(self.chunks)
+		return data[-self.max_bytes:].decode("utf-8", errors = "replace")
+
+RESTART_DELAY_MS = 500
+MAX_RESTART_DELAY_MS = 30000
+# a server that stayed up this long is considered healthy again
+STABLE_UPTIME = 60
 
 class RefactProcessWrapper():
 	def __init__(self):
 		self.connection = None
+		self.process = None
 		self.active = False
+		self.starting = False
+		self.stopping = False
+		self.restart_pending = False
+		self.restart_callback = None
+		self.restart_count = 0
+		self.failures = 0
+		self.started_at = 0
+		self.down_since = None
+		self.downtime = 0
+		self.last_exit_code = None
+		self.exit_lock = threading.Lock()
 		self.statusbar = StatusBar()
+		self.server_log = ServerLog(get_setting("server_log_kb", 256) * 1024)
 
 	def get_server_path(self):
+		# "server_path" can point at another build, or at benchmarks/fake_refact_lsp.py
+		server_path = get_setting("server_path", "").strip()
+		if server_path:
+			return os.path.expanduser(server_path)
 		return os.path.join(sublime.packages_path(), "refact", "server", "refact-lsp")
 
-	def get_server_commands(self):
-		s = sublime.load_settings("refact.sublime-settings")
+	def get_server_address(self):
+		return get_setting("server_address", "").strip()
 
-		address_url = s.get("address_url", "")
+	def get_server_commands(self):
+		address_url = get_setting("address_url", "")
 		address_url = address_url if len(address_url) > 0 else "Refact"
-		api_key = s.get("api_key", "")
+		api_key = get_setting("api_key", "")
 		options = [
 			self.get_server_path(),
 			"--address-url",  address_url,
@@ -28,33 +94,140 @@ class RefactProcessWrapper():
 			"--lsp-stdin-stdout", "1",
 		]
 
-		telemetry_basic = s.get("telemetry_basic", False)
+		telemetry_basic = get_setting("telemetry_basic", False)
 		if telemetry_basic:
 			options.append("--basic-telemetry")
 
-		telemetry_code_snippets = s.get("telemetry_code_snippets", False)
+		telemetry_code_snippets = get_setting("telemetry_code_snippets", False)
 		if telemetry_basic:
 			options.append("--snippet-telemetry")
 
 		return options
 
 	def start_server(self):
+		# returns right away, the server is spawned and initialized on the async
+		# worker while calls to the new connection are queued
+		self.stopping = False
 		self.active = True
+		self.starting = True
+		address = self.get_server_address()
+		connection = LSP(self.statusbar, shared = bool(address))
+		old_connection = self.connection
+		self.connection = connection
+		self.statusbar.update_statusbar("warming")
+		sublime.set_timeout_async(lambda: self.launch(connection, old_connection, address))
+
+	def launch(self, connection, old_connection, address):
+		if not old_connection is None:
+			old_connection.shutdown()
+		if not connection is self.connection or self.stopping:
+			# stopped or restarted again before we got here
+			connection.set_ready()
+			return
+
+		try:
+			process = self.spawn(address)
+		except Exception as err:
+			self.starting = False
+			self.active = False
+			self.statusbar.handle_err(err)
+			connection.set_ready()
+			self.down_since = self.down_since or time.monotonic()
+			self.schedule_restart()
+			return
+
+		old_process = self.process
+		self.process = process
+		self.starting = False
+		if old_process and old_process.poll() is None:
+			old_process.terminate()
+		if process.stderr is None:
+			# a shared server writes its log elsewhere
+			self.server_log.append(("connected to %s\n" % address).encode())
+		elif IoLoop.supports(process.stderr):
+			get_io_loop().add_reader(process.stderr, lambda: self.server_log.read(process.stderr))
+		else:
+			threading.Thread(target = self.server_log.drain, args = (process.stderr,), daemon = True).start()
+		self.started_at = time.monotonic()
+		if not self.down_since is None:
+			self.downtime = self.downtime + self.started_at - self.down_since
+			self.down_since = None
+
+		# waiting for the exit code must not hold up the io loop
+		connection.connect(process, lambda: sublime.set_timeout_async(lambda: self.on_server_exit(process)))
+		if self.stopping and process is self.process:
+			# stopped while initialize was running
+			connection.shutdown()
+			process.terminate()
+			self.statusbar.update_statusbar("pause")
+
+	def spawn(self, address):
+		if address:
+			# connect to a server shared with other editors instead of starting one
+			return SocketProcess(address)
+
 		server_cmds = self.get_server_commands()
 		startupinfo = None
 		if os.name == 'nt':
 			startupinfo = subprocess.STARTUPINFO()
 			startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-		self.process = subprocess.Popen(server_cmds, startupinfo=startupinfo, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
+		return subprocess.Popen(server_cmds, startupinfo=startupinfo, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
+
+	def is_alive(self):
+		if self.starting:
+			return self.active
+		return self.active and self.process.poll() is None
+
+	def on_server_exit(self, process):
+		# called from the io loop or reader thread once the server closed its stdout,
+		# or when poll() finds the process gone
+		with self.exit_lock:
+			if not process is self.process or self.stopping or self.starting or not self.active:
+				return
+			self.active = False
+		try:
+			self.last_exit_code = process.wait(timeout = 1)
+		except subprocess.TimeoutExpired:
+			process.kill()
+		self.down_since = time.monotonic()
+		if self.down_since - self.started_at > STABLE_UPTIME:
+			self.failures = 0
+		self.schedule_restart()
 
-		self.statusbar.update_statusbar("ok")
-		if not self.connection is None:
-			self.connection.shutdown()
+	def schedule_restart(self):
+		delay = min(RESTART_DELAY_MS * (2 ** self.failures), MAX_RESTART_DELAY_MS)
+		self.failures = self.failures + 1
+		self.restart_pending = True
+		self.statusbar.update_statusbar("error", msg = "server quit, restarting in %.1fs" % (delay / 1000))
+		sublime.set_timeout_async(self.restart, delay)
 
-		self.connection = LSP(self.process, self.statusbar)
+	def restart(self):
+		self.restart_pending = False
+		if self.stopping or self.active:
+			return
+
+		self.restart_count = self.restart_count + 1
+		self.start_server()
+		if self.restart_callback:
+			self.restart_callback()
+
+	def get_status(self):
+		downtime = self.downtime
+		if not self.down_since is None:
+			downtime = downtime + time.monotonic() - self.down_since
+		status = "restarts: %d, downtime: %.1fs, last exit code: %s" % (self.restart_count, downtime, self.last_exit_code)
+		stats = self.connection.get_stats() if self.connection else None
+		if stats:
+			status = status + "\nrequests pending: %d, timed out: %d, cancelled: %d, late responses: %d, orphaned responses: %d" % (stats["pending"], stats["timeouts"], stats["cancelled"], stats["late_responses"], stats["orphaned_responses"])
+		return status
+
+	def get_server_log(self):
+		return self.server_log.get_text()
 
 	def stop_server(self):
+		self.stopping = True
+		self.active = False
 		self.connection.shutdown()
-		self.process.terminate()
+		if self.process:
+			self.process.terminate()
 		self.statusbar.update_statusbar("pause")
-
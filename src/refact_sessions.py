@@ -6,27 +6,68 @@ import time
 import traceback
 
 from .utils import *
-from .refact_lsp import LSP, get_language_id
+from .refact_lsp import LSP, get_syntax_language_id
+from .pylspclient.lsp_endpoint import PendingRequest
 from .refact_process import RefactProcessWrapper
 from .phantom_state import PhantomState, PhantomInsertion
 from .completion_text import get_nonwhitespace
+from .completion_scheduler import CompletionScheduler
+from .completion_cache import CompletionCache
+from . import reload_state
+from .settings import settings_cache, get_setting, is_server_setting_changed
+from .perf_stats import CompletionTrace, perf_stats
 
 class RefactSessionManager:
 
 	def __init__(self):
 		self.connection = None
-		self.process = RefactProcessWrapper()
-		self.connection = self.process.start_server()
+		self.completion_cache = CompletionCache(get_setting("completion_cache_entries", 256), get_setting("completion_cache_bytes", 1024 * 1024))
 		self.views = {}
+		self.parked_documents = {}
+		parked = reload_state.take(RefactProcessWrapper)
+		if parked:
+			# the package was reloaded, the server and the documents it knows are still there
+			self.process, self.parked_documents = parked
+		else:
+			self.process = RefactProcessWrapper()
+			self.process.start_server()
+		self.process.restart_callback = self.replay_documents
+		settings_cache.set_listener("session_manager", self.on_settings_change)
 
 	def start(self):
+		self.completion_cache.clear()
 		self.connection = self.process.start_server()
+		self.replay_documents()
 		
+	def on_settings_change(self, name, changed):
+		# only a change to what the server was started with needs a new one
+		if is_server_setting_changed(name, changed) and self.process.active:
+			self.start()
+		if "completion_debounce_ms" in changed or "completion_max_wait_ms" in changed:
+			for session in self.views.values():
+				session.configure_scheduler()
+
+	def park(self):
+		# hands the server over to the next plugin_loaded
+		if self.process.stopping:
+			return
+		documents = {}
+		for view_id, session in self.views.items():
+			session.clear_completion()
+			if session.view.is_valid():
+				documents[view_id] = session.get_sync_state()
+			# the next plugin_loaded creates new sessions for these views
+			session.close()
+		reload_state.park(self.process, documents)
+
 	def shutdown(self):
 		if self.process and self.process.active:
 			self.process.stop_server()
 		for key, session in self.views.items():
 			session.clear_completion()
+			session.close()
+		# recreated on demand, they open their documents with the next server
+		self.views = {}
 
 	def get_view_id(self, view):
 		if view.element() is None:
@@ -35,19 +76,38 @@ class RefactSessionManager:
 			return "UI"
 
 	def get_connection(self):
-		if not self.process.active:
+		if self.process.active and not self.process.is_alive():
+			self.process.on_server_exit(self.process.process)
+		if not self.process.active and not self.process.restart_pending:
 			self.process.start_server()
 		return self.process.connection
 
+	def replay_documents(self):
+		# the restarted server knows nothing about the open documents
+		self.parked_documents = {}
+		with self.process.connection.batch():
+			for session in list(self.views.values()):
+				if session.view.is_valid():
+					session.open_document()
+
+	def find_session(self, view):
+		return self.views.get(self.get_view_id(view))
+
+	def close_session(self, view):
+		session = self.views.pop(self.get_view_id(view), None)
+		if session:
+			session.close()
+
 	def get_session(self, view):
 		view_id = self.get_view_id(view)
 		if not view_id in self.views:
-			self.views[view_id] = RefactSession(view, self.get_connection, view_id == "UI")
+			self.views[view_id] = RefactSession(view, self.get_connection, self.completion_cache, view_id == "UI", self.parked_documents.pop(view_id, None))
 		return self.views[view_id]
 
 class RefactSession:
-	def __init__(self, view, connection, is_ui = False):
+	def __init__(self, view, connection, completion_cache, is_ui = False, sync_state = None):
 		self.completion_in_process = False
+		self.pending_request = None
 		self.session_state = 0
 		self.version = 0
 		self.view = view
@@ -60,28 +120,127 @@ class RefactSession:
 
 		self.phantom_state = PhantomState(view)
 		self.connection = connection
+		self.completion_cache = completion_cache
 		self.current_completion = None
 		self.is_ui = is_ui;
-		syntax = view.scope_name(get_cursor_point(view))
-		file_type = syntax[(syntax.rindex(".") + 1):].strip()
-		self.languageId = get_language_id(file_type)
-		self.connection().load_document(self.file_name, get_text(self.view), self.languageId)
-	
+		self.syntax_path = view.settings().get("syntax")
+		self.languageId = get_syntax_language_id(view.syntax())
+		view.settings().add_on_change("refact.syntax", self.on_view_settings_change)
+		self.incremental_sync = get_setting("incremental_sync", True)
+		self.completion_scheduler = CompletionScheduler(self.request_completion)
+		self.configure_scheduler()
+		self.sync_check_pending = False
+		self.last_trigger = None
+		if sync_state and sync_state[1] is self.connection():
+			self.restore_sync_state(sync_state)
+		else:
+			self.open_document()
+
+	def configure_scheduler(self):
+		self.completion_scheduler.debounce_ms = get_setting("completion_debounce_ms", 100)
+		self.completion_scheduler.max_wait_ms = get_setting("completion_max_wait_ms", 400)
+
+	def close(self):
+		# stops listening to the view, a reloaded plugin must not find it subscribed
+		self.view.settings().clear_on_change("refact.syntax")
+		self.phantom_state.close()
+
+	def on_view_settings_change(self):
+		syntax_path = self.view.settings().get("syntax")
+		if syntax_path == self.syntax_path:
+			return
+		self.syntax_path = syntax_path
+		language_id = get_syntax_language_id(self.view.syntax())
+		if language_id == self.languageId:
+			return
+		# the server only learns a document's language when it is opened
+		self.languageId = language_id
+		if not self.is_ui:
+			self.connection().did_close(self.file_name)
+			self.open_document()
+
+	def get_sync_state(self):
+		return (self.file_name, self.synced_connection, self.synced_change_count, self.version)
+
+	def restore_sync_state(self, sync_state):
+		# the server still has the document from before the reload, edits made
+		# in between are caught by the change count check
+		self.file_name, self.synced_connection, self.synced_change_count, self.version = sync_state
+		self.sync_trusted = True
+		self.check_sync()
+
+	def open_document(self):
+		self.synced_connection = self.connection()
+		self.synced_change_count = self.view.change_count()
+		self.sync_trusted = True
+		self.version = self.synced_change_count
+		self.synced_connection.load_document(self.file_name, get_text(self.view), version = self.version, languageId = self.languageId)
+
+	def invalidate_sync(self):
+		self.sync_trusted = False
+
+	def is_synced(self):
+		return self.sync_trusted and self.synced_change_count == self.view.change_count()
+
+	def sync_full(self):
+		connection = self.connection()
+		if not connection is self.synced_connection:
+			# a restarted server has never seen this document
+			self.open_document()
+			return
+		self.version = self.view.change_count()
+		self.synced_change_count = self.version
+		self.sync_trusted = connection.did_change(self.file_name, self.version, get_text(self.view))
+
+	def notify_text_changes(self, changes):
+		if self.is_ui or not self.incremental_sync:
+			return
+
+		change_count = self.view.change_count()
+		if self.synced_change_count == change_count:
+			return
+
+		connection = self.connection()
+		if not connection.supports_incremental_sync():
+			return
+
+		if not self.sync_trusted or not connection is self.synced_connection or len(changes) == 0:
+			self.sync_full()
+			return
+
+		self.version = change_count
+		self.synced_change_count = change_count
+		self.sync_trusted = connection.did_change_incremental(self.file_name, self.version, changes)
+
 	def notify_document_update(self):
-		if self.is_ui or self.phantom_state.update_step:
+		if self.is_ui or self.phantom_state.update_step or not self.view.is_primary():
 			return
-		self.connection().did_change(self.file_name, self.version, get_text(self.view), self.languageId)
+
+		if self.incremental_sync:
+			# text change deltas for this edit may still be on their way, only
+			# resend the whole buffer if they never arrive
+			if not self.sync_check_pending:
+				self.sync_check_pending = True
+				sublime.set_timeout(self.check_sync)
+			return
+
+		self.sync_full()
+
+	def check_sync(self):
+		self.sync_check_pending = False
+		if not self.is_synced():
+			self.sync_full()
 
 	def notify_close(self):
 		if self.is_ui or self.phantom_state.update_step:
 			return
-		self.connection().did_close(self.file_name, self.version, get_text(self.view), self.languageId)
+		self.connection().did_close(self.file_name)
 
 	def notify_save(self):
 		if self.is_ui or self.phantom_state.update_step:
 			return
 
-		self.connection().did_save(self.file_name, self.version, get_text(self.view), self.languageId)
+		self.connection().did_save(self.file_name)
 
 	def update_completion(self):
 		if self.is_ui :
@@ -95,10 +254,34 @@ class RefactSession:
 			return
 
 		if self.has_completion():
+			# type through the visible suggestion instead of asking again
+			text = self.phantom_state.advance_seed()
+			if not text is None:
+				self.current_completion = text
 			self.phantom_state.update()
-		if not self.completion_visible() and not self.completion_in_process:
-			text = get_cursor_line(self.view)
-			self.show_completions(text, [get_cursor_point(self.view)], len(text) == 0 or text.isspace())
+			if not self.completion_visible():
+				# diverged from or exhausted the suggestion
+				self.clear_completion()
+		if not self.completion_visible():
+			self.schedule_completion()
+
+	def schedule_completion(self):
+		if self.is_ui:
+			return
+		self.last_trigger = time.monotonic()
+		self.completion_scheduler.schedule()
+
+	def request_completion(self):
+		# runs once per burst of typing, with the cursor state at that time
+		if self.is_ui or self.phantom_state.update_step or self.completion_visible():
+			return True
+		if self.completion_in_process:
+			# the request in flight is for an older cursor state
+			self.cancel_pending_request()
+			return False
+		text = get_cursor_line(self.view)
+		self.show_completions(text, [get_cursor_point(self.view)], len(text) == 0 or text.isspace())
+		return True
 
 	def completion_visible(self):
 		return self.has_completion() and self.phantom_state.are_phantoms_visible()
@@ -111,23 +294,37 @@ class RefactSession:
 
 	def clear_completion(self):
 		self.session_state = self.session_state + 1
+		self.completion_scheduler.cancel()
+		self.cancel_pending_request()
 		self.current_completion = None
 		self.phantom_state.clear_phantoms()
 
 	def is_paused(self):
-		s = sublime.load_settings("refact.sublime-settings")
-		return s.get("pause_completion")
+		return get_setting("pause_completion")
 		
+	def cancel_pending_request(self):
+		pending_request = self.pending_request
+		if pending_request:
+			pending_request.cancel()
+
 	def clear_completion_process(self):
+		self.pending_request = None
 		self.completion_in_process = False
+		sublime.set_timeout(self.completion_scheduler.idle)
 
 	def show_completions(self, prefix, locations, multiline = False):
 		if not self.phantom_state.update_step and not self.completion_in_process:
 			self.completion_in_process = True
-			sublime.set_timeout_async(lambda:self.show_completions_inner(self.session_state, prefix, locations, multiline))
+			pending_request = PendingRequest()
+			self.pending_request = pending_request
+			trace = CompletionTrace(self.last_trigger or time.monotonic())
+			trace.mark("debounce")
+			sublime.set_timeout_async(lambda:self.show_completions_inner(self.session_state, prefix, locations, multiline, pending_request, trace))
 
-	def set_phantoms(self, version, location, completion):
+	def set_phantoms(self, version, location, completion, trace = None):
 		if self.session_state != version or not self.is_position_valid(location):
+			# the user moved on while the completion was on its way
+			perf_stats.count("stale_discarded")
 			self.clear_completion_process()
 			return
 
@@ -143,6 +340,9 @@ class RefactSession:
 		else:
 			self.current_completion = completion
 			self.phantom_state.set_new_phantoms([[PhantomInsertion(location, completion)]])
+		if trace and self.phantom_state.are_phantoms_visible():
+			trace.mark("render")
+			trace.finish()
 		self.clear_completion_process()
 
 	def is_position_valid(self, location):
@@ -155,8 +355,11 @@ class RefactSession:
 				return False
 		return True
 
-	def show_completions_inner(self, version, prefix, locations, multiline = False):
+	def show_completions_inner(self, version, prefix, locations, multiline = False, pending_request = None, trace = None):
+		trace = trace or CompletionTrace(time.monotonic())
+		trace.mark("queue")
 		if version != self.session_state:
+			perf_stats.count("stale_discarded")
 			self.clear_completion_process()
 			return
 
@@ -179,23 +382,45 @@ class RefactSession:
 			pos_arg = (rc[0], 0)
 		else:
 			pos_arg = rc
-		res = self.connection().get_completions(self.file_name, pos_arg, multiline)
+		cache_key = self.completion_cache.make_key(self.file_name, pos_arg, multiline, get_context(self.view, location))
+		completions = self.completion_cache.get(cache_key)
+		trace.mark("prepare")
+		if not completions is None:
+			perf_stats.count("cache_hits")
+			self.show_completion_choices(version, location, rc, completions, trace)
+			return
 
+		# the async worker is free for other views while the server answers
+		future = self.connection().get_completions_async(self.file_name, pos_arg, multiline, pending_request)
+		future.add_done_callback(lambda future: self.on_response(version, location, rc, cache_key, future.result(), trace))
+
+	def on_response(self, version, location, rc, cache_key, res, trace):
+		trace.mark("request")
+		sublime.set_timeout_async(lambda: self.on_completions(version, location, rc, cache_key, res, trace))
+
+	def on_completions(self, version, location, rc, cache_key, res, trace = None):
+		if trace:
+			trace.mark("dispatch")
 		if res is None:
 			self.clear_completion_process()
 			return
 
-		completions = res["choices"]
+		completions = [s['code_completion'] for s in res["choices"]]
+		if len(completions) == 0:
+			self.clear_completion_process()
+			return
+		self.completion_cache.put(cache_key, completions)
+		self.show_completion_choices(version, location, rc, completions, trace)
 
-		if len(completions) > 0:
-			completion = completions[0]['code_completion']
-			if not completion or len(completion) == 0 or completion.isspace():
-				self.clear_completion_process()
-				return 
+	def show_completion_choices(self, version, location, rc, completions, trace = None):
+		completion = completions[0]
+		if not completion or len(completion) == 0 or completion.isspace():
+			self.clear_completion_process()
+			return 
 
 		text = get_line(self.view, location)
-		suggestions = [text[:rc[1]] + s['code_completion'] for s in completions]
-		sublime.set_timeout(lambda: self.set_phantoms(version, location, suggestions[0]))
+		suggestions = [text[:rc[1]] + s for s in completions]
+		sublime.set_timeout(lambda: self.set_phantoms(version, location, suggestions[0], trace))
 
 	def accept_completion(self):
 		if self.is_ui or self.phantom_state.update_step:
@@ -0,0 +1,79 @@
+import socket
+import threading
+
+CONNECT_TIMEOUT = 5
+
+def parse_address(address):
+	# "unix:///path/to/socket", "tcp://host:port" or just "host:port"
+	if address.startswith("unix://"):
+		return socket.AF_UNIX, address[len("unix://"):]
+	if address.startswith("tcp://"):
+		address = address[len("tcp://"):]
+	host, separator, port = address.rpartition(":")
+	if not separator or not port.isdigit():
+		raise ValueError("server_address should look like tcp://127.0.0.1:8001 or unix:///path/to/socket, got " + address)
+	return socket.AF_INET, (host.strip("[]") or "127.0.0.1", int(port))
+
+def connect_socket(address, timeout = CONNECT_TIMEOUT):
+	family, target = parse_address(address)
+	if family == socket.AF_INET:
+		sock = socket.create_connection(target, timeout)
+		# LSP messages are small, don't let Nagle hold them back
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+	else:
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			sock.settimeout(timeout)
+			sock.connect(target)
+		except OSError:
+			sock.close()
+			raise
+	sock.settimeout(None)
+	return sock
+
+class SocketProcess:
+	# A connection to a refact-lsp that was started elsewhere and may be
+	# shared with other editors. It stands in for the subprocess.Popen of a
+	# server we started ourselves, so the supervisor treats a dropped
+	# connection like a server exit and reconnects with the same backoff.
+	def __init__(self, address):
+		self.address = address
+		self.sock = connect_socket(address)
+		self.stdin = self.sock.makefile("wb")
+		self.stdout = self.sock.makefile("rb")
+		self.stderr = None
+		# initialize must not tie the shared server's lifetime to us
+		self.pid = None
+		self.returncode = None
+		self.lock = threading.Lock()
+
+	def poll(self):
+		return self.returncode
+
+	def wait(self, timeout = None):
+		# the connection is gone once the reader saw EOF
+		self.close()
+		return self.returncode
+
+	def terminate(self):
+		self.close()
+
+	def kill(self):
+		self.close()
+
+	def close(self):
+		with self.lock:
+			if not self.returncode is None:
+				return
+			self.returncode = 0
+		try:
+			# wakes up the reader with EOF, closing alone doesn't while the files are open
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+		for stream in (self.stdin, self.stdout):
+			try:
+				stream.close()
+			except (OSError, ValueError):
+				pass
+		self.sock.close()
@@ -0,0 +1,58 @@
+import sys
+import types
+import sublime
+
+# Reloading the package re-executes the plugin and may re-import everything
+# under refact.src, but sys.modules itself survives. The running server is
+# parked there under a name no reload touches, so the next plugin_loaded
+# reattaches to it instead of starting a new one.
+HOLDER_NAME = "refact_reload_state"
+# a server nobody reattached to within this time is stopped, the package was
+# disabled or removed rather than reloaded
+RELOAD_GRACE_MS = 5000
+
+def get_holder():
+	holder = sys.modules.get(HOLDER_NAME)
+	if holder is None:
+		holder = types.ModuleType(HOLDER_NAME)
+		holder.parked = None
+		holder.generation = 0
+		sys.modules[HOLDER_NAME] = holder
+	return holder
+
+def park(process, documents):
+	# documents maps view ids to what the server already knows about them
+	holder = get_holder()
+	holder.generation = holder.generation + 1
+	holder.parked = (process, documents)
+	generation = holder.generation
+	sublime.set_timeout_async(lambda: release(generation), RELOAD_GRACE_MS)
+
+def release(generation = None):
+	holder = get_holder()
+	if holder.parked is None or (not generation is None and generation != holder.generation):
+		return
+	process = holder.parked[0]
+	holder.parked = None
+	retire(process)
+
+def retire(process):
+	if process.active:
+		process.stop_server()
+	else:
+		# keeps a pending restart from bringing it back
+		process.stopping = True
+
+def take(process_class):
+	holder = get_holder()
+	parked = holder.parked
+	holder.parked = None
+	if parked is None:
+		return None
+
+	process = parked[0]
+	if not type(process) is process_class or process.stopping:
+		# the process wrapper's code was reloaded as well, start over with the new code
+		retire(process)
+		return None
+	return parked
@@ -0,0 +1,75 @@
+import sublime
+import threading
+
+REFACT_SETTINGS = "refact.sublime-settings"
+ON_CHANGE_KEY = "refact"
+# a running server only picks these up when it is restarted
+SERVER_SETTINGS = ["address_url", "api_key", "telemetry_basic", "telemetry_code_snippets", "server_address", "server_path", "lsp_record_path"]
+
+class SettingsCache:
+	# load_settings and Settings.get are calls into the editor, too slow for
+	# the per keystroke paths. Values are cached per settings file and read
+	# again when Sublime reports a change to the file, listeners are then told
+	# which of them changed.
+	def __init__(self):
+		self.files = {}
+		self.values = {}
+		self.listeners = {}
+		self.lock = threading.Lock()
+
+	def get(self, key, default = None, name = REFACT_SETTINGS):
+		values = self.values.get(name)
+		if values is None or not key in values:
+			return self.load(name, key, default)
+		value = values[key]
+		return default if value is None else value
+
+	def load(self, name, key, default):
+		settings = self.get_file(name)
+		value = settings.get(key)
+		with self.lock:
+			self.values.setdefault(name, {})[key] = value
+		return default if value is None else value
+
+	def get_file(self, name):
+		settings = self.files.get(name)
+		if settings is None:
+			settings = sublime.load_settings(name)
+			settings.clear_on_change(ON_CHANGE_KEY)
+			settings.add_on_change(ON_CHANGE_KEY, lambda: self.on_change(name))
+			self.files[name] = settings
+		return settings
+
+	def on_change(self, name):
+		# re-read every key seen so far, so later changes to them are noticed too
+		settings = self.files[name]
+		with self.lock:
+			old_values = self.values.get(name, {})
+		new_values = {key: settings.get(key) for key in old_values}
+		with self.lock:
+			self.values[name] = new_values
+		changed = [key for key, value in new_values.items() if old_values[key] != value]
+		if not changed:
+			return
+		for listener in list(self.listeners.values()):
+			listener(name, changed)
+
+	def set_listener(self, key, listener):
+		# listener(name, changed_keys) runs when cached values of a settings file changed;
+		# a key holds a single listener, so a reloaded plugin replaces its old one
+		self.listeners[key] = listener
+
+	def remove_listener(self, key):
+		self.listeners.pop(key, None)
+
+settings_cache = SettingsCache()
+
+def get_setting(key, default = None):
+	return settings_cache.get(key, default)
+
+def get_view_setting(view, key, default = None):
+	value = view.settings().get(key)
+	return default if value is None else value
+
+def is_server_setting_changed(name, changed):
+	return name == REFACT_SETTINGS and any(key in SERVER_SETTINGS for key in changed)
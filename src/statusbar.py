@@ -1,37 +1,46 @@
-
 import sublime
+import threading
+import time
+
+FRAME_MS = 100
+STATUS_KEY = "refact"
 
 class StatusBar:
+	# Updates only record the new state and make sure one render is scheduled,
+	# so any number of them between two frames cost a single redraw. The timer
+	# keeps running only while the spinner turns, otherwise nothing is
+	# scheduled at all. The text is set as a view status, which stays visible
+	# without being refreshed.
 	def __init__(self):
-		self.update_statusbar("ok")
-		self.status_loop()
 		self.icons = [u"◐", u"◓", u"◑", u"◒"]
 		self.current_icon = 0
-		self.duration = 0
-
-	def status_loop(self):
-		display = ""
-		if self.status == "error":
-			display = '⛔refact.ai:' + self.msg
-		elif self.status == "pause":
-			display ="⏸️ refact.ai"
-		elif self.status == "ok":
-			display = "refact.ai"
-		elif self.status == "loading":
-			display = self.icons[self.current_icon] + "refact.ai"
-			self.current_icon = (self.current_icon + 1 ) % len(self.icons)
-
-		sublime.status_message(display)
-		if self.duration > 0 or self.status == "loading":
-			if self.duration > 0:
-				self.duration = self.duration - 1
-		sublime.set_timeout(self.status_loop, 100)
+		self.status = "ok"
+		self.msg = ""
+		self.in_flight = 0
+		self.last_latency = None
+		self.display = None
+		self.render_pending = False
+		self.lock = threading.Lock()
+		self.update_statusbar("ok")
 
 	def update_statusbar(self, status, msg = ""):
-		self.status = status
-		self.msg = msg
-		self.duration = 5
-		self.status_loop()
+		with self.lock:
+			self.status = status
+			self.msg = msg
+		self.schedule_render(0)
+
+	def request_started(self):
+		with self.lock:
+			self.in_flight = self.in_flight + 1
+		self.schedule_render(0)
+
+	def request_finished(self, latency = None):
+		# latency is None for requests that got no answer
+		with self.lock:
+			self.in_flight = max(self.in_flight - 1, 0)
+			if not latency is None:
+				self.last_latency = latency
+		self.schedule_render(0)
 
 	def handle_err(self, err):
 		if not isinstance(err, str):
@@ -39,4 +48,52 @@ class StatusBar:
 				err = err.message
 			else:
 				err = str(err)
-		self.update_statusbar("error", msg = str(err))
\ No newline at end of file
+		self.update_statusbar("error", msg = str(err))
+
+	def schedule_render(self, delay):
+		with self.lock:
+			if self.render_pending:
+				return
+			self.render_pending = True
+		sublime.set_timeout(self.render, delay)
+
+	def is_animated(self):
+		return self.status == "warming" or (self.status == "ok" and self.in_flight > 0)
+
+	def get_display(self):
+		if self.status == "error":
+			return '⛔refact.ai:' + self.msg
+		elif self.status == "pause":
+			return "⏸️ refact.ai"
+		elif self.status == "warming":
+			return self.icons[self.current_icon] + "refact.ai warming up"
+
+		display = "refact.ai"
+		if not self.last_latency is None:
+			display = display + " %dms" % (self.last_latency * 1000)
+		if self.in_flight > 0:
+			display = self.icons[self.current_icon] + display
+			if self.in_flight > 1:
+				display = display + " (%d in flight)" % self.in_flight
+		return display
+
+	def render(self):
+		with self.lock:
+			self.render_pending = False
+			animated = self.is_animated()
+			if animated:
+				self.current_icon = (self.current_icon + 1) % len(self.icons)
+			display = self.get_display()
+			changed = display != self.display
+			self.display = display
+
+		if changed:
+			for window in sublime.windows():
+				self.show(window.active_view())
+		if animated:
+			self.schedule_render(FRAME_MS)
+
+	def show(self, view):
+		# views that become active later get the current text from on_activated
+		if view and not self.display is None:
+			view.set_status(STATUS_KEY, self.display)
@@ -18,6 +18,12 @@ def get_previous_line(view, point):
 	line = view.line(point)
 	return view.line(line.a - 1)
 
+def get_context(view, point, lines_before = 20, lines_after = 3):
+	row = view.rowcol(point)[0]
+	start = view.text_point(max(row - lines_before, 0), 0)
+	end = view.line(view.text_point(row + lines_after, 0)).b
+	return view.substr(sublime.Region(start, end))
+
 def set_cursor_position(view, position):
 	sel = view.sel()
 	if len(sel) > 0 and sel[0].intersects(position):
@@ -37,9 +43,7 @@ def filter_none(l):
 def identity(x):
 	return x
 
-def replace_tab(text):
-	s = sublime.load_settings("Preferences.sublime-settings")
-	tab_size = s.get("tab_size", 4)
+def replace_tab(text, tab_size = 4):
 	return text.replace('\t', ' ' * tab_size)
 
 
@@ -0,0 +1,49 @@
+import unittest
+
+from src.pylspclient.json_rpc_endpoint import MessageBuffer
+from src.pylspclient.lsp_structs import ResponseError
+
+
+def frame(body):
+    return b"Content-Length: %d\r\n\r\n" % len(body) + body
+
+
+def drain(buffer):
+    messages = []
+    errors = 0
+    while True:
+        try:
+            message = buffer.next_message()
+        except ResponseError:
+            errors += 1
+            continue
+        if message is None:
+            return messages, errors
+        messages.append(message)
+
+
+class MessageBufferTest(unittest.TestCase):
+    def test_split_frames(self):
+        data = frame(b'{"id": 1}') + frame(b'{"id": 2}')
+        buffer = MessageBuffer()
+        messages = []
+        for i in range(len(data)):
+            buffer.feed(data[i:i + 1])
+            messages.extend(drain(buffer)[0])
+        self.assertEqual(messages, [{"id": 1}, {"id": 2}])
+
+    def test_bad_header_skips_to_next_frame(self):
+        buffer = MessageBuffer()
+        buffer.feed(b"X-Bogus: 1\r\n\r\n{\"id\": 0}" + frame(b'{"id": 1}') + frame(b'{"id": 2}'))
+        self.assertEqual(drain(buffer), ([{"id": 1}, {"id": 2}], 1))
+
+    def test_bad_header_resyncs_across_reads(self):
+        buffer = MessageBuffer()
+        buffer.feed(b"Content-Length: x\r\n\r\ngarbage Content-Le")
+        self.assertEqual(drain(buffer), ([], 1))
+        buffer.feed(frame(b'{"id": 1}')[len(b"Content-Le"):])
+        self.assertEqual(drain(buffer), ([{"id": 1}], 0))
+
+
+if __name__ == "__main__":
+    unittest.main()